@@ -0,0 +1,210 @@
+"""
+Server HTTP che imita Ollama (/api/tags, /api/chat, /api/generate) con latenza
+e velocita' di generazione configurabili: risposte preconfezionate e
+deterministiche (topic, quiz JSON, voti, chat) per i benchmark offline.
+
+Uso standalone:  python -m benchmarks.fake_ollama --port 11500 --latency 0.2 --tokens-per-s 200
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_MODELS = ["qwen2.5:14b", "gemma2:27b", "llama3.1:8b"]
+
+# Vocabolario sintetico: ogni domanda pesca parole diverse, cosi' il filtro
+# dei quasi-duplicati non scarta l'output canned
+_VOCAB = [f"{a}{b}" for a in ("crypto", "cipher", "hash", "key", "block", "stream", "proto", "sign", "nonce", "mac")
+          for b in ("alpha", "beta", "gamma", "delta", "omega", "sigma", "theta", "kappa", "lambda", "zeta")]
+
+
+class FakeOllamaConfig:
+    def __init__(self, latency: float = 0.1, tokens_per_s: float = 200.0, models=None, seed: int = 0):
+        self.latency = latency            # secondi prima del primo token (prefill)
+        self.tokens_per_s = tokens_per_s  # velocita' di decoding
+        self.models = models or list(DEFAULT_MODELS)
+        self.seed = seed
+
+
+class _State:
+    def __init__(self, config: FakeOllamaConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.requests = {"chat": 0, "generate": 0, "tags": 0}
+
+    def words(self, n: int) -> str:
+        with self.lock:
+            self.counter += 1
+            return " ".join(self.rng.choice(_VOCAB) for _ in range(n)) + f" {self.counter}"
+
+
+def _question(state: _State, kind: str) -> dict:
+    text = state.words(8)
+    if kind == "open_ended":
+        return {"question": f"Explain {text}?", "type": "open_ended", "options": [], "answer": f"Because {text}", "explanation": "canned"}
+    options = [state.words(3) for _ in range(4)]
+    return {"question": f"What is {text}?", "type": "multiple_choice", "options": options, "answer": options[0], "explanation": "canned"}
+
+
+def canned_reply(state: _State, prompt: str) -> str:
+    """Risposta plausibile per ciascun prompt del backend, riconosciuto dal testo."""
+    if "Information Architect" in prompt:
+        m = re.search(r"list of (\d+) DISTINCT", prompt)
+        return ", ".join(state.words(2).title() for _ in range(int(m.group(1)) if m else 30))
+    if "Grade EACH" in prompt:
+        count = len(re.findall(r"^\s*ITEM \d+:", prompt, re.M))
+        return json.dumps({"grades": [{"item": i + 1, "score": 80, "feedback": "Good.", "ideal_answer": "canned"} for i in range(count)]})
+    if "Grade the user's answer" in prompt:
+        return json.dumps({"score": 80, "feedback": "Good.", "ideal_answer": "canned"})
+    if "JSON Editor" in prompt:
+        # Refine: rimanda indietro le domande del draft
+        m = re.search(r"Input Draft:\s*(.*?)\n\s*RULES:", prompt, re.S)
+        return m.group(1).strip() if m else json.dumps({"questions": []})
+    m = re.search(r"Generate exactly (\d+) quiz questions", prompt)
+    if m:
+        types = re.findall(r"Type: (\w+)", prompt)
+        qty = int(m.group(1))
+        return json.dumps({"questions": [_question(state, types[i] if i < len(types) else "multiple_choice") for i in range(qty)]})
+    if "Senior Quiz Editor" in prompt:
+        return json.dumps(_question(state, "multiple_choice"))
+    return "This is a canned answer based on the provided context. " + state.words(20)
+
+
+def _tokens(text: str):
+    # ~4 caratteri per token, come la stima usata dal backend
+    return [text[i:i + 4] for i in range(0, len(text), 4)] or [""]
+
+
+def make_handler(state: _State):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, obj, status=200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/api/tags"):
+                state.requests["tags"] += 1
+                return self._json({"models": [{"name": m, "model": m} for m in state.config.models]})
+            if self.path.startswith("/api/version"):
+                return self._json({"version": "0.0.0-fake"})
+            self._json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self.path.startswith("/api/chat"):
+                state.requests["chat"] += 1
+                prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+                return self._generate(body, prompt, chat=True)
+            if self.path.startswith("/api/generate"):
+                state.requests["generate"] += 1
+                if not body.get("prompt"):
+                    # Preload del modello (prompt vuoto)
+                    time.sleep(state.config.latency)
+                    return self._json(self._final(body, chat=False, load_s=state.config.latency))
+                return self._generate(body, body["prompt"], chat=False)
+            self._json({"error": "not found"}, 404)
+
+        def _final(self, body, chat: bool, content: str = "", load_s: float = 0.0, eval_count: int = 0, prompt: str = ""):
+            final = {
+                "model": body.get("model", ""),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "done": True,
+                "done_reason": "stop",
+                "load_duration": int(load_s * 1e9),
+                "prompt_eval_count": len(prompt) // 4 + 1,
+                "eval_count": eval_count,
+            }
+            if chat: final["message"] = {"role": "assistant", "content": content}
+            else: final["response"] = content
+            return final
+
+        def _generate(self, body, prompt: str, chat: bool):
+            cfg = state.config
+            tokens = _tokens(canned_reply(state, prompt))
+            start = time.time()
+            time.sleep(cfg.latency)
+
+            if not body.get("stream", True):
+                time.sleep(len(tokens) / cfg.tokens_per_s)
+                return self._json(self._final(body, chat, "".join(tokens), eval_count=len(tokens), prompt=prompt))
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, tok in enumerate(tokens):
+                delay = start + cfg.latency + (i + 1) / cfg.tokens_per_s - time.time()
+                if delay > 0: time.sleep(delay)
+                chunk = {"model": body.get("model", ""), "created_at": datetime.now(timezone.utc).isoformat(), "done": False}
+                if chat: chunk["message"] = {"role": "assistant", "content": tok}
+                else: chunk["response"] = tok
+                self._chunk(chunk)
+            self._chunk(self._final(body, chat, eval_count=len(tokens), prompt=prompt))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, obj):
+            data = (json.dumps(obj) + "\n").encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    return Handler
+
+
+class FakeOllama:
+    """Server in un thread di background: start() ritorna l'URL da usare come OLLAMA_HOST."""
+
+    def __init__(self, config: FakeOllamaConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.state = _State(config or FakeOllamaConfig())
+        self.server = ThreadingHTTPServer((host, port), make_handler(self.state))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Ollama server for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=200.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeOllama(FakeOllamaConfig(args.latency, args.tokens_per_s, seed=args.seed), args.host, args.port)
+    print(f"🧪 Fake Ollama listening on {server.url} (latency {args.latency}s, {args.tokens_per_s} tok/s)")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Benchmark end-to-end del backend senza Ollama reale: avvia il fake Ollama,
+indicizza i PDF in una cartella temporanea e misura load_context,
+generate_quiz_task, /chat e /quiz/grade (p50/p95, throughput, picco di RSS).
+I risultati vanno in un file JSON confrontabile con --compare.
+
+Esempi (dalla cartella backend):
+    python -m benchmarks.run_benchmarks --fake-embeddings
+    python -m benchmarks.run_benchmarks --runs 5 --compare benchmarks/results/bench_20260101-120000.json
+"""
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+from langchain_core.embeddings import Embeddings
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+# Metriche confrontate con --compare: True = piu' alto e' meglio
+COMPARED_METRICS = {"p50_s": False, "p95_s": False, "peak_rss_mb": False, "throughput": True}
+
+
+# --- MISURE ---
+
+class PeakRSS:
+    """Campiona la RSS del processo in background e ne tiene il massimo."""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0
+        self._proc = psutil.Process()
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._proc.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._proc.memory_info().rss
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak / (1024 ** 2), 1)
+
+
+def percentile(values, p: float) -> float:
+    return round(float(np.percentile(values, p)), 4) if values else 0.0
+
+
+def summarize(latencies, items: int, elapsed: float, rss: PeakRSS, unit: str, **extra) -> dict:
+    return {
+        "runs": len(latencies),
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "mean_s": round(float(np.mean(latencies)), 4) if latencies else 0.0,
+        "throughput": round(items / elapsed, 3) if elapsed > 0 else 0.0,
+        "throughput_unit": unit,
+        "peak_rss_mb": rss.peak_mb,
+        **extra,
+    }
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Embedding deterministici (bag of words con hashing), senza torch ne' download:
+    isolano i benchmark dal costo di MiniLM. Stessa interfaccia di HuggingFaceEmbeddings.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _vec(self, text: str) -> list:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            h = int.from_bytes(hashlib.md5(word.encode()).digest()[:8], "little")
+            vec[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm > 0 else vec).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._vec(text)
+
+
+# --- SCENARI ---
+
+def bench_load_context(engine, files, runs: int) -> dict:
+    """Indicizzazione a freddo (shard cancellati ad ogni run) e ricarica dagli shard."""
+    from src.ai_engine import SHARD_DIR
+    cold, warm = [], []
+    stats = None
+    with PeakRSS() as rss:
+        start = time.time()
+        for _ in range(runs):
+            shutil.rmtree(SHARD_DIR, ignore_errors=True)
+            engine.contexts.clear()
+            t0 = time.time()
+            engine.load_context(files)
+            cold.append(time.time() - t0)
+            stats = engine.last_ingest_stats or {}
+
+            engine.contexts.clear()
+            t0 = time.time()
+            engine.load_context(files)
+            warm.append(time.time() - t0)
+        elapsed = time.time() - start
+    chunks = (stats or {}).get("chunks", 0)
+    return summarize(cold, chunks * runs, sum(cold), rss, "chunks/s",
+                     warm_p50_s=percentile(warm, 50), pages=(stats or {}).get("pages", 0),
+                     chunks=chunks, total_s=round(elapsed, 2))
+
+
+def bench_generation(engine, runs: int, num_questions: int, mode: str) -> dict:
+    from src.models import QuizRequest
+    latencies, first_question, produced = [], [], 0
+    with PeakRSS() as rss:
+        start = time.time()
+        for i in range(runs):
+            job_id = f"bench-{i}-{int(time.time() * 1000)}"
+            request = QuizRequest(num_questions=num_questions, model_id="balanced", question_type="mixed",
+                                  custom_prompt="", language="English", generation_mode=mode,
+                                  refresh_topics=(i == 0))
+            engine.jobs.create(job_id, {"status": "pending", "progress": 0, "total": num_questions})
+            t0 = time.time()
+            worker = threading.Thread(target=engine.generate_quiz_task, args=(job_id, request))
+            worker.start()
+            # Primo evento "questions" sullo stream: tempo alla prima domanda utilizzabile
+            cursor, first = 0, None
+            while worker.is_alive() or first is None:
+                events = engine.events.wait_for(job_id, cursor, timeout=0.2)
+                cursor += len(events)
+                if first is None and any(e[1] == "questions" for e in events):
+                    first = time.time() - t0
+                if not worker.is_alive() and not events: break
+            worker.join()
+            latencies.append(time.time() - t0)
+            if first is not None: first_question.append(first)
+            job = engine.jobs.get(job_id) or {}
+            produced += len(job.get("result") or [])
+        elapsed = time.time() - start
+    return summarize(latencies, produced, elapsed, rss, "questions/s", mode=mode,
+                     questions_per_job=num_questions, questions_produced=produced,
+                     first_question_p50_s=percentile(first_question, 50))
+
+
+def bench_http(client, path: str, payload_fn, runs: int, concurrency: int) -> dict:
+    def call(i):
+        t0 = time.time()
+        res = client.post(path, json=payload_fn(i))
+        return time.time() - t0, res.status_code
+
+    with PeakRSS() as rss:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(call, range(runs)))
+        elapsed = time.time() - start
+    errors = sum(1 for _, status in results if status != 200)
+    return summarize([r[0] for r in results], runs, elapsed, rss, "requests/s",
+                     concurrency=concurrency, errors=errors)
+
+
+# --- CONFRONTO ---
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Stampa le differenze per scenario; ritorna le regressioni oltre `threshold` (frazione)."""
+    regressions = []
+    print(f"\n📊 Comparison with baseline ({baseline.get('meta', {}).get('timestamp', '?')}):")
+    for name, cur in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base: continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = base.get(metric), cur.get(metric)
+            if not old or new is None: continue
+            delta = (new - old) / old
+            worse = -delta if higher_is_better else delta
+            flag = "❌" if worse > threshold else "✅"
+            print(f"   {flag} {name:<18} {metric:<12} {old:>10} -> {new:<10} ({delta:+.1%})")
+            if worse > threshold: regressions.append(f"{name}.{metric}")
+    return regressions
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline backend benchmarks (fake Ollama)")
+    parser.add_argument("--docs", nargs="*", help="PDFs to index (default: document_library/*.pdf)")
+    parser.add_argument("--runs", type=int, default=3, help="runs of load_context / generation")
+    parser.add_argument("--requests", type=int, default=20, help="requests for /chat and /quiz/grade")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel clients for /chat and /quiz/grade")
+    parser.add_argument("--questions", type=int, default=20, help="questions per generation job")
+    parser.add_argument("--mode", default="two_step", choices=["two_step", "single_pass"])
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Ollama time to first token (s)")
+    parser.add_argument("--tokens-per-s", type=float, default=2000.0, help="fake Ollama decoding speed")
+    parser.add_argument("--fake-embeddings", action="store_true", help="deterministic hashed embeddings instead of MiniLM")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/bench_<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--keep-workdir", action="store_true")
+    args = parser.parse_args()
+
+    docs = args.docs or sorted(glob.glob(os.path.join(BACKEND_DIR, "document_library", "*.pdf")))
+    docs = [os.path.abspath(d) for d in docs]
+    if not docs: sys.exit("No PDF to benchmark: pass --docs")
+
+    from .fake_ollama import FakeOllama, FakeOllamaConfig
+    fake = FakeOllama(FakeOllamaConfig(latency=args.latency, tokens_per_s=args.tokens_per_s))
+    fake_url = fake.start()
+
+    # Cartella di lavoro isolata: indici, cache, job e banca domande del benchmark non toccano quelli veri
+    workdir = tempfile.mkdtemp(prefix="quiz_bench_")
+    os.makedirs(os.path.join(workdir, "document_library"))
+    files = []
+    for path in docs:
+        shutil.copy(path, os.path.join(workdir, "document_library"))
+        files.append(os.path.basename(path))
+
+    os.environ.update({
+        "OLLAMA_HOST": fake_url,
+        "QUIZ_WARMUP": "0",
+        "QUIZ_JOB_STORE": "memory",
+        "QUIZ_SEMANTIC_CACHE": "0",
+        # Prima di importare src.*: i percorsi dei DB (job, banca domande) si leggono all'import
+        "QUIZ_DATA_DIR": os.path.join(workdir, "data"),
+    })
+    for var in ("QUIZ_JOB_DB", "QUIZ_QUESTION_BANK_DB"): os.environ.pop(var, None)
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+
+    print(f"🧪 Fake Ollama on {fake_url} | workdir {workdir} | {len(files)} PDFs")
+    rss_start = psutil.Process().memory_info().rss
+    t0 = time.time()
+    from fastapi.testclient import TestClient
+    from src.main import app
+    from src.ai_engine import engine
+    import_s = time.time() - t0
+    if args.fake_embeddings:
+        engine.vector_store._embeddings = HashEmbeddings()
+    engine.load_llm("balanced")
+
+    scenarios = {}
+    try:
+        print("⏱️  load_context...")
+        scenarios["load_context"] = bench_load_context(engine, files, args.runs)
+        print("⏱️  generate_quiz_task...")
+        scenarios["generate_quiz"] = bench_generation(engine, args.runs, args.questions, args.mode)
+
+        client = TestClient(app)
+        print("⏱️  /chat...")
+        scenarios["chat"] = bench_http(client, "/chat", lambda i: {
+            "question": f"What is the role of the key schedule in round {i}?", "language": "English"},
+            args.requests, args.concurrency)
+        print("⏱️  /quiz/grade...")
+        scenarios["grade"] = bench_http(client, "/quiz/grade", lambda i: {
+            "question": "What does a MAC guarantee?", "correct_answer": "Integrity and authenticity",
+            "user_answer": f"It guarantees integrity of message {i}", "language": "English"},
+            args.requests, args.concurrency)
+    finally:
+        fake.stop()
+        os.chdir(BACKEND_DIR)
+        if not args.keep_workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "docs": files,
+            "fake_embeddings": args.fake_embeddings,
+            "fake_ollama": {"latency_s": args.latency, "tokens_per_s": args.tokens_per_s},
+            "import_s": round(import_s, 3),
+            "rss_start_mb": round(rss_start / (1024 ** 2), 1),
+            "args": vars(args),
+        },
+        "scenarios": scenarios,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    print("\n🏁 Results:")
+    for name, s in scenarios.items():
+        print(f"   {name:<15} p50 {s['p50_s']:.3f}s  p95 {s['p95_s']:.3f}s  "
+              f"{s['throughput']} {s['throughput_unit']}  peak RSS {s['peak_rss_mb']} MB")
+    print(f"💾 Saved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        if regressions:
+            print(f"⚠️ Regressions: {', '.join(regressions)}")
+            if args.fail_on_regression: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
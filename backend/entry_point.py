@@ -1,11 +1,15 @@
 import uvicorn
 import os
 import sys
+import multiprocessing
 
 # src path
 sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
 
-from src.main import app
-
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8001)
\ No newline at end of file
+    # Necessario per il pool di processi dell'indicizzazione nel bundle PyInstaller.
+    # L'app si importa solo dopo: con spawn i worker rieseguono questo modulo e non
+    # devono costruire un AIEngine (che segnerebbe come interrotti i job in corso)
+    multiprocessing.freeze_support()
+    from src.main import app
+    uvicorn.run(app, host="127.0.0.1", port=8001)
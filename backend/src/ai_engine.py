@@ -1,125 +1,384 @@
 import os
-import shutil
 import gc
 import json
-import requests
-import math
 import time 
 import random 
-from typing import List
-
-# Import AI
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings 
-from langchain_community.vectorstores import FAISS 
-from langchain_ollama import ChatOllama
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Optional
+
+# Import AI (quelli pesanti - Ollama, HuggingFace, FAISS, PyPDF - sono caricati al primo uso)
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
+from pydantic import ValidationError
 
 # Import Locali
 from .models import AVAILABLE_MODELS, QuizRequest, AIQuizOutput, AIQuestion
-from .utils import clean_json_output
+from .utils import clean_json_output, normalize_text, estimate_tokens, get_memory_stats, JsonItemStream
+from .vector_store import VectorStoreManager, search_many, RETRIEVAL_MODE
+from .ann_index import drop_ann_cache
+from .contexts import ContextRegistry, LoadedContext, context_id_for
+from .cache import DiskCache, ResponseCache, make_key
+from .ingestion import ingest_files
+from .events import JobEventBus
+from .job_store import create_job_store
+from . import ollama_client
+from .context_packer import PackedBatch, pack_batches, max_topics_per_batch
+from .dedup import EmbeddingDeduper, QUESTION_DEDUP_THRESHOLD, TOPIC_DEDUP_THRESHOLD
+from .question_bank import create_question_bank
+from .metrics import registry, timed, llm_metrics, PHASE_SECONDS, JSON_PARSE
 
-DB_DIR = "vector_db_ctx" 
+DB_DIR = "vector_db_ctx"   # indice del formato precedente agli shard (solo lettura)
 LIBRARY_DIR = "document_library"
+# Stato generato a runtime (catalogo dei contesti, indici ANN): fuori da vector_db_ctx, che e' versionato
+CONTEXT_DIR = os.path.join(LIBRARY_DIR, ".contexts")
+CONTEXT_CATALOG = os.path.join(CONTEXT_DIR, "context.json")
+SHARD_DIR = os.path.join(LIBRARY_DIR, ".index_cache")
+CACHE_DIR = os.path.join(LIBRARY_DIR, ".cache")
+
+TOPIC_BATCH_SIZE = 10  # massimo: il packer riduce i batch che non stanno in num_ctx
+# Batch del Builder in parallelo: ha senso fino a OLLAMA_NUM_PARALLEL richieste servite insieme
+BUILDER_CONCURRENCY = int(os.environ.get("QUIZ_BUILDER_CONCURRENCY") or os.environ.get("OLLAMA_NUM_PARALLEL") or 2)
+# Schema passato al parametro `format` di Ollama nella modalita' single_pass
+QUIZ_JSON_SCHEMA = AIQuizOutput.model_json_schema()
+# Istruzione {output_format} del prompt del Builder: chiamate vincolate allo schema / draft libero
+STRUCTURED_OUTPUT_FORMAT = 'JSON object {"domande": [...]} matching the given schema.'
+DRAFT_OUTPUT_FORMAT = "JSON List."
+TOPIC_CACHE_SIZE = int(os.environ.get("QUIZ_TOPIC_CACHE_SIZE", "64"))
+CONTEXT_MISSING_MSG = "Context not found. Please upload a file."
+# Cache delle risposte di grading e chat (lookup semantico opzionale)
+RESPONSE_CACHE_SIZE = int(os.environ.get("QUIZ_RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = float(os.environ.get("QUIZ_RESPONSE_CACHE_TTL_HOURS", "720")) * 3600
+SEMANTIC_CACHE = os.environ.get("QUIZ_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("QUIZ_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# Grading a pacchetti: risposte brevi nello stesso prompt
+GRADE_PACK_MAX = int(os.environ.get("QUIZ_GRADE_PACK_MAX", "6"))
+GRADE_PACK_ITEM_TOKENS = 600   # oltre questa stima un item viene valutato da solo
+GRADE_OUTPUT_TOKENS = 150      # spazio riservato per voto + feedback di ogni item
+GRADING_RULES = """
+        GRADING RULES:
+        1. **IGNORE Typos & Grammar:** Do NOT penalize spelling mistakes (e.g., "algortmo", "perche", missing accents) unless the answer is completely unreadable. Focus ONLY on the meaning.
+        2. **Semantic Match:** If the user conveys the core concept correctly, give a HIGH score (90-100), even if the phrasing is informal.
+        3. **Technical Accuracy:** If the user mentions correct advanced concepts (like Shannon's Theorem, K >= M, etc.) that are relevant, REWARD them, do not criticize them for being "brief".
+        4. **Feedback Tone:** Be encouraging. If the answer is correct but has typos, mention the typos gently in the feedback but DO NOT lower the score for them.
+        """
+FALLBACK_TOPICS = ["General Concepts", "Details", "Analysis"]
+# 0 = nessun warm-up all'avvio: tutto viene caricato alla prima richiesta
+WARMUP_ON_START = os.environ.get("QUIZ_WARMUP", "1") == "1"
+# Durante il warm-up carica anche i pesi del modello in Ollama (non solo il client)
+PRELOAD_ON_START = os.environ.get("QUIZ_OLLAMA_PRELOAD", "1") == "1"
+# Modello da tenere caldo dopo ogni cambio (es. "max_logic"), vuoto = nessuno
+WARM_NEXT_MODEL = os.environ.get("QUIZ_WARM_NEXT_MODEL", "")
+# Parsing + embedding dei PDF subito dopo l'upload (in background): selezionarli poi e' immediato
+PREINDEX_ON_UPLOAD = os.environ.get("QUIZ_PREINDEX", "1") == "1"
+# Domande scartate dal parser (item rotti o non validi): quante richieste extra per rigenerare solo quelle
+SALVAGE_RETRIES = int(os.environ.get("QUIZ_SALVAGE_RETRIES", "1"))
 
 class AIEngine:
     def __init__(self):
+        init_start = time.time()
         self.llm = None
         self.current_model_id = "default"
-        self.jobs = {} 
-        self.active_files = [] 
-        self.load_llm("balanced") 
+        self.ctx_size = 8192
+        self.keep_alive = ollama_client.DEFAULT_KEEP_ALIVE
+        self.last_load = None
+        self._llm_lock = threading.RLock()
+        self.warmup_state = "pending"
+        self.startup_timings = {}
+        self.jobs = create_job_store()
+        self.events = JobEventBus()
+        self.vector_store = VectorStoreManager(DB_DIR, SHARD_DIR, CONTEXT_DIR)
+        self._relocate_runtime_state()
+        self.contexts = ContextRegistry(CONTEXT_CATALOG, self.vector_store.build_context,
+                                        fallback=self.vector_store.load_legacy)
+        self.last_ingest_stats = None
+        # Un solo worker: i file caricati si indicizzano in coda, senza contendersi CPU ed embedder
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pre-index")
+        self.index_status = {}
+        self.question_bank = create_question_bank()
+        self.topic_cache = DiskCache(os.path.join(CACHE_DIR, "topics"), max_entries=TOPIC_CACHE_SIZE)
+        embed_fn = self._embed_text if SEMANTIC_CACHE else None
+        self.grade_cache = ResponseCache(os.path.join(CACHE_DIR, "grading"), RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                                         embed_fn=embed_fn, threshold=SEMANTIC_CACHE_THRESHOLD)
+        self.chat_cache = ResponseCache(os.path.join(CACHE_DIR, "chat"), RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                                        embed_fn=embed_fn, threshold=SEMANTIC_CACHE_THRESHOLD)
         if not os.path.exists(LIBRARY_DIR): os.makedirs(LIBRARY_DIR)
+        registry.register_collector(self._collect_metrics)
+        self.startup_timings["engine_init"] = round(time.time() - init_start, 3)
 
-    def _check_ollama_model_exists(self, model_name: str) -> bool:
+    # --- AVVIO E WARM-UP ---
+
+    def start_warmup(self):
+        """Carica i sottosistemi pesanti in background, dopo che il server e' in ascolto."""
+        if not WARMUP_ON_START or self.warmup_state != "pending":
+            self.warmup_state = "skipped" if not WARMUP_ON_START else self.warmup_state
+            return
+        threading.Thread(target=self._warmup, name="engine-warmup", daemon=True).start()
+
+    def _warmup(self):
+        self.warmup_state = "running"
+        phases = [
+            ("warmup_llm", lambda: self.load_llm("balanced", preload=PRELOAD_ON_START)),
+            ("warmup_embeddings", self.vector_store.get_embeddings),
+            ("warmup_vector_db", self.contexts.get),
+            ("warmup_library_scan", self.scan_library),
+        ]
+        for name, fn in phases:
+            t0 = time.time()
+            try: fn()
+            except Exception as e: print(f"   ⚠️ Warm-up step {name} failed: {e}")
+            self.startup_timings[name] = round(time.time() - t0, 3)
+        self.warmup_state = "done"
+        print(f"🔥 [SYSTEM] Warm-up completed: {self.startup_timings}")
+
+    def readiness(self) -> dict:
+        return {
+            "warmup": self.warmup_state,
+            "llm": self.llm is not None,
+            "embeddings": self.vector_store.embeddings_loaded,
+            "vector_db": self.contexts.peek() is not None,
+        }
+
+    @staticmethod
+    def _relocate_runtime_state():
+        """Catalogo e indici ANN scritti in vector_db_ctx dalle versioni precedenti: si spostano in CONTEXT_DIR."""
+        old_catalog = os.path.join(DB_DIR, "context.json")
         try:
-            res = requests.get("http://localhost:11434/api/tags")
-            if res.status_code == 200:
-                models = [m['name'] for m in res.json().get('models', [])]
-                return any(model_name in m for m in models)
-        except: pass
-        return True 
-
-    def load_llm(self, model_key: str):
+            if os.path.exists(old_catalog) and not os.path.exists(CONTEXT_CATALOG):
+                os.makedirs(CONTEXT_DIR, exist_ok=True)
+                os.replace(old_catalog, CONTEXT_CATALOG)
+            drop_ann_cache(DB_DIR)
+        except OSError as e:
+            print(f"   ⚠️ Could not move context state out of {DB_DIR}: {e}")
+
+    def _get_llm(self):
+        if self.llm is None: self.load_llm("balanced")
+        return self.llm
+
+    def _check_ollama_model_exists(self, model_name: str) -> bool:
+        models = ollama_client.list_models()
+        if models is None: return True
+        return any(model_name in m for m in models)
+
+    @staticmethod
+    def _model_config(model_key: str) -> dict:
         config = AVAILABLE_MODELS.get(model_key, AVAILABLE_MODELS.get("balanced"))
-        if not config: config = list(AVAILABLE_MODELS.values())[0]
+        return config or list(AVAILABLE_MODELS.values())[0]
 
-        if self.current_model_id == model_key and self.llm is not None: return True
+    @staticmethod
+    def _ctx_size_for(model_id: str) -> int:
+        return 4096 if "27b" in model_id else 8192
+
+    def load_llm(self, model_key: str, keep_alive: str = None, preload: bool = False):
+        with self._llm_lock:
+            return self._load_llm_locked(model_key, keep_alive, preload)
+
+    def _load_llm_locked(self, model_key: str, keep_alive: str = None, preload: bool = False):
+        config = self._model_config(model_key)
+        keep_alive = keep_alive or self.keep_alive
+
+        if self.current_model_id == model_key and self.llm is not None and keep_alive == self.keep_alive:
+            # Client gia' pronto: il preload rinnova solo il keep_alive in Ollama
+            if preload: self._preload(config["id"], self.ctx_size, keep_alive)
+            return True
 
         print(f"🔌 [SYSTEM] Switching Model to: {config['name']}...")
+        if not self._check_ollama_model_exists(config["id"]):
+            print(f"   ❌ Model {config['id']} is not installed in Ollama.")
+            if model_key != "balanced":
+                print("   ⚠️ Fallback to Balanced model.")
+                return self.load_llm("balanced", keep_alive, preload)
         try:
+            from langchain_ollama import ChatOllama
             self.llm = None
             gc.collect()
-            ctx_size = 4096 if "27b" in config["id"] else 8192 
-            self.llm = ChatOllama(model=config["id"], temperature=0.1, num_ctx=ctx_size) 
+            ctx_size = self._ctx_size_for(config["id"])
+            self.llm = ChatOllama(model=config["id"], temperature=0.1, num_ctx=ctx_size,
+                                  base_url=ollama_client.OLLAMA_URL, keep_alive=keep_alive,
+                                  callbacks=[llm_metrics])
             self.current_model_id = model_key
+            self.ctx_size = ctx_size
+            self.keep_alive = keep_alive
             print(f"   ✅ Model Loaded. VRAM Context: {ctx_size}")
+            if preload: self._preload(config["id"], ctx_size, keep_alive)
             return True
         except Exception as e:
             print(f"   ❌ Connection failed: {e}")
             if model_key != "balanced":
                 print("   ⚠️ Fallback to Balanced model.")
-                return self.load_llm("balanced")
+                return self.load_llm("balanced", keep_alive, preload)
             return False
 
-    def load_context(self, filenames: List[str]):
-        if set(filenames) == set(self.active_files) and self.get_vector_db() is not None:
-            return len(filenames)
+    def _preload(self, model_id: str, ctx_size: int, keep_alive: str):
+        """Porta i pesi in memoria subito, invece che alla prima richiesta dell'utente."""
+        try:
+            self.last_load = ollama_client.preload(model_id, ctx_size, keep_alive)
+            print(f"   🔥 Weights loaded in {self.last_load['load_s']}s (keep_alive: {keep_alive})")
+        except Exception as e:
+            self.last_load = {"model": model_id, "keep_alive": keep_alive, "error": str(e)}
+            print(f"   ⚠️ Preload of {model_id} failed: {e}")
+        return self.last_load
+
+    def warm_model(self, model_key: str, keep_alive: str = None):
+        """Precarica in background un altro modello (es. il prossimo che servira')."""
+        model_key = model_key or WARM_NEXT_MODEL
+        if not model_key or model_key == self.current_model_id or model_key not in AVAILABLE_MODELS: return None
+        config = self._model_config(model_key)
+        ollama_client.preload_async(config["id"], self._ctx_size_for(config["id"]), keep_alive or self.keep_alive)
+        return model_key
+
+    @property
+    def active_files(self) -> List[str]:
+        """File del contesto di default (l'ultimo caricato), usato dalle richieste senza context_id."""
+        return self.contexts.files()
+
+    def load_context(self, filenames: List[str]) -> Optional[LoadedContext]:
+        # Serializza i rebuild: due load-context concorrenti non devono scrivere gli stessi shard
+        with self.vector_store.lock:
+            return self._load_context_locked(filenames)
 
+    def _load_context_locked(self, filenames: List[str]) -> Optional[LoadedContext]:
         print(f"📂 [SYSTEM] Indexing {len(filenames)} files: {filenames}")
-        gc.collect() 
-        if os.path.exists(DB_DIR):
-            try: shutil.rmtree(DB_DIR)
-            except: pass
-            
-        all_docs = []
-        loaded_files = []
+        self.last_ingest_stats = None
+
+        # 1. Shard per file: si ricalcolano solo i file nuovi o modificati
+        shards = {}
+        to_build = []
         for f_name in filenames:
             path = os.path.join(LIBRARY_DIR, f_name)
             if not os.path.exists(path): continue
             try:
-                loader = PyPDFLoader(path)
-                docs = loader.load()
-                for d in docs: d.metadata['source'] = f_name 
-                all_docs.extend(docs)
-                loaded_files.append(f_name)
+                key = self.vector_store.shard_key(path)
             except Exception as e:
                 print(f"   ❌ Error loading {f_name}: {e}")
+                continue
+            if self.vector_store.has_shard(key):
+                print(f"   ♻️ Cached shard: {f_name}")
+            else:
+                to_build.append((f_name, path, key))
+            shards[f_name] = key
+
+        if to_build:
+            stats = ingest_files(to_build, self.vector_store.get_embeddings(), self._save_shard)
+            self.last_ingest_stats = stats.to_dict()
+            for f_name in stats.failed: shards.pop(f_name, None)
+
+        if not shards: return None
 
-        if not all_docs: return 0
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=200)
-        splits = text_splitter.split_documents(all_docs)
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        # 2. Il contesto e' il merge degli shard: se e' gia' residente (stessi contenuti) si riusa
+        context_id = context_id_for(shards.values())
+        ctx = self.contexts.peek(context_id)
+        if ctx is not None:
+            ctx.shards = shards   # stessi contenuti, i nomi dei file possono essere cambiati
+            self.contexts.add(ctx)
+            print(f"   ♻️ Context {context_id} already resident ({ctx.db.index.ntotal} chunks).")
+            return ctx
         try:
-            vector_db = FAISS.from_documents(splits, embeddings)
-            vector_db.save_local(DB_DIR)
-            self.active_files = loaded_files
-            print(f"   ✅ Index created: {len(splits)} chunks.")
-            return len(loaded_files)
+            ctx = self.vector_store.build_context(context_id, shards)
+            if ctx is None: return None
+            self.contexts.add(ctx)
+            self.contexts.retire_fallback()
+            print(f"   ✅ Index ready: {ctx.db.index.ntotal} chunks (context {context_id}, {ctx.size_bytes / 1024 ** 2:.1f} MB).")
+            return ctx
         except Exception as e:
             print(f"   ❌ DB Error: {e}")
-            return 0
+            return None
+
+    def _save_shard(self, f_name: str, key: str, shard_db):
+        self.vector_store.save_shard(key, shard_db)
+
+    # --- PRE-INDICIZZAZIONE DEGLI UPLOAD ---
 
-    def get_vector_db(self):
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-        if os.path.exists(DB_DIR):
-            try: return FAISS.load_local(DB_DIR, embeddings, allow_dangerous_deserialization=True)
-            except: return None
+    def find_duplicate(self, key: str, exclude: str = None) -> Optional[str]:
+        """Nome del file in libreria con lo stesso contenuto (stessa chiave di shard), se esiste."""
+        for f_name in sorted(os.listdir(LIBRARY_DIR)):
+            if not f_name.endswith(".pdf") or f_name == exclude: continue
+            try:
+                if self.vector_store.shard_key(os.path.join(LIBRARY_DIR, f_name)) == key: return f_name
+            except OSError:
+                continue
         return None
 
+    def schedule_indexing(self, f_name: str):
+        if not PREINDEX_ON_UPLOAD: return
+        self.index_status[f_name] = {"state": "queued", "queued_at": time.time()}
+        self.indexer.submit(self._pre_index, f_name)
+
+    def _pre_index(self, f_name: str):
+        path = os.path.join(LIBRARY_DIR, f_name)
+        status = self.index_status.get(f_name)
+        if status is None or not os.path.exists(path): return   # cancellato mentre era in coda
+        start = time.time()
+        try:
+            # Stesso lock di load_context: se il file viene selezionato ora, trova lo shard pronto
+            with self.vector_store.lock:
+                key = self.vector_store.shard_key(path)
+                if self.vector_store.has_shard(key):
+                    status.update(state="indexed", cached=True)
+                    return
+                status["state"] = "indexing"
+                print(f"📥 [PRE-INDEX] {f_name}")
+                stats = ingest_files([(f_name, path, key)], self.vector_store.get_embeddings(), self._save_shard)
+            if stats.failed:
+                # "No text extracted" solo per i PDF vuoti, altrimenti l'eccezione reale
+                status.update(state="failed", error=stats.errors.get(f_name, "Indexing failed"))
+            else:
+                status.update(state="indexed", pages=stats.pages, chunks=stats.chunks)
+        except Exception as e:
+            print(f"   ❌ Pre-indexing failed for {f_name}: {e}")
+            status.update(state="failed", error=str(e))
+        finally:
+            status["seconds"] = round(time.time() - start, 2)
+
+    def scan_library(self):
+        """Calcola una volta le chiavi dei PDF in libreria (stato di indicizzazione e dedup degli upload)."""
+        for f_name in os.listdir(LIBRARY_DIR):
+            if not f_name.endswith(".pdf"): continue
+            try: self.vector_store.shard_key(os.path.join(LIBRARY_DIR, f_name))
+            except OSError: pass
+
+    def forget_file(self, f_name: str):
+        self.index_status.pop(f_name, None)
+
+    def indexing_status(self, files: List[str]) -> dict:
+        """Stato per file: queued | indexing | indexed | failed | not_indexed (unknown finche' non e' stato letto)."""
+        result = {}
+        for f_name in files:
+            status = self.index_status.get(f_name)
+            if status is not None:
+                result[f_name] = dict(status)
+                continue
+            key = self.vector_store.known_key(os.path.join(LIBRARY_DIR, f_name))
+            state = "unknown" if key is None else "indexed" if self.vector_store.has_shard(key) else "not_indexed"
+            result[f_name] = {"state": state}
+        return result
+
+    def retrieve_many(self, ctx: LoadedContext, queries: List[str], k: int) -> List[list]:
+        """Documenti per ogni query, in ordine, con un'unica embedding + search (ibrida se c'e' l'indice BM25)."""
+        return search_many(ctx.db, queries, k, ctx.sparse if RETRIEVAL_MODE == "hybrid" else None)
+
+    def _set_phase(self, job_id: str, phase: str):
+        self.jobs.update(job_id, phase=phase)
+        self.events.publish(job_id, "phase", {"phase": phase, "status": self.jobs.get_status(job_id)})
+
+    def cancel_job(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None: return False
+        self.jobs.update(job_id, status="cancelled")
+        self.events.publish(job_id, "cancelled", {"progress": job.get("progress", 0)})
+        return True
+
     def _is_cancelled(self, job_id: str) -> bool:
-        if job_id in self.jobs and self.jobs[job_id].get("status") == "cancelled":
+        if self.jobs.get_status(job_id) == "cancelled":
             print(f"⛔ Job {job_id[:8]} detected as CANCELLED. Aborting task.")
             return True
         return False
 
-    def extract_key_topics(self, vector_db, num_topics: int, lang: str) -> List[str]:
+    def extract_key_topics(self, ctx: LoadedContext, num_topics: int, lang: str) -> List[str]:
         print(f"🏗️  [ARCHITECT] Analyzing document structure for {num_topics} micro-topics...")
         
-        retriever = vector_db.as_retriever(search_kwargs={'k': 25}) 
-        docs = retriever.invoke("Table of contents hierarchy structure chapter summary glossary definitions")
+        docs = self.retrieve_many(ctx, ["Table of contents hierarchy structure chapter summary glossary definitions"], k=25)[0]
         context = "\n".join([d.page_content[:1500] for d in docs])
         
         prompt_text = """
@@ -132,10 +391,10 @@ class AIEngine:
         TEXT PREVIEW: {context}
         """
         prompt = ChatPromptTemplate.from_template(prompt_text)
-        chain = prompt | self.llm | StrOutputParser()
+        chain = prompt | self._get_llm() | StrOutputParser()
         
         try:
-            res = chain.invoke({"num": num_topics, "context": context, "lang": lang})
+            res = chain.invoke({"num": num_topics, "context": context, "lang": lang}, config={"tags": ["architect"]})
             raw_list = res.replace('\n', ',').split(',')
             topics = []
             for t in raw_list:
@@ -150,9 +409,107 @@ class AIEngine:
             return unique_topics[:num_topics]
             
         except Exception:
-            return ["General Concepts", "Details", "Analysis"]
+            return list(FALLBACK_TOPICS)
+
+    def _model_name(self) -> str:
+        return AVAILABLE_MODELS.get(self.current_model_id, {}).get("id", self.current_model_id)
+
+    def _embed_text(self, text: str) -> list:
+        return self.vector_store.get_embeddings().embed_query(text)
+
+    def cache_stats(self) -> dict:
+        return {"topics": self.topic_cache.stats(), "grading": self.grade_cache.stats(), "chat": self.chat_cache.stats()}
+
+    def _collect_metrics(self) -> list:
+        """Valori letti al momento dello scrape: cache e memoria."""
+        lookups = {}
+        for name, stats in self.cache_stats().items():
+            lookups[(name, "hit")] = stats["hits"]
+            lookups[(name, "miss")] = stats["misses"]
+            if "semantic_hits" in stats: lookups[(name, "semantic_hit")] = stats["semantic_hits"]
+        mem = get_memory_stats()
+        contexts = self.contexts.stats()
+        chunks = {(c["context_id"],): c["chunks"] for c in contexts["resident"]}
+        return [
+            ("quiz_cache_lookups_total", "counter", "Cache lookups by cache and result", ("cache", "result"), lookups),
+            ("quiz_process_resident_memory_bytes", "gauge", "Backend process RSS", (), {(): mem["process_rss_bytes"]}),
+            ("quiz_system_memory_total_bytes", "gauge", "Total system RAM", (), {(): mem["total_bytes"]}),
+            ("quiz_system_memory_used_percent", "gauge", "System RAM in use", (), {(): mem["used_percent"]}),
+            ("quiz_vector_index_chunks", "gauge", "Chunks in each resident context index", ("context",), chunks),
+            ("quiz_context_resident_bytes", "gauge", "Estimated RAM of the resident contexts", (),
+             {(): int(contexts["resident_mb"] * 1024 ** 2)}),
+            ("quiz_context_evictions_total", "counter", "Contexts unloaded by the LRU", (), {(): contexts["evictions"]}),
+        ]
+
+    def get_topic_pool(self, ctx: LoadedContext, pool_size: int, lang: str, refresh: bool = False) -> List[str]:
+        """Pool dell'Architect, riusato da cache per (corpus, lingua, modello, dimensione)."""
+        fingerprint = ctx.fingerprint
+        key = make_key(fingerprint, lang, self._model_name(), pool_size) if fingerprint else None
+
+        if key and not refresh:
+            cached = self.topic_cache.get(key)
+            if cached:
+                print(f"♻️  [ARCHITECT] Topic pool from cache ({len(cached)} topics)")
+                return list(cached)
+
+        topics = self.extract_key_topics(ctx, pool_size, lang)
+        # Il fallback generico non va in cache: al prossimo job si riprova
+        if key and topics and topics != FALLBACK_TOPICS:
+            self.topic_cache.set(key, topics)
+        return topics
+
+    @staticmethod
+    def _question_type_at(request: QuizRequest, position: int) -> str:
+        if request.question_type == 'mixed':
+            # Una Open Ended ogni 5, il resto Multiple Choice
+            return "open_ended" if (position + 1) % 5 == 0 else "multiple_choice"
+        if "aperta" in request.question_type or "open" in request.question_type:
+            return "open_ended"
+        return "multiple_choice"
+
+    def _questions_from_bank(self, request: QuizRequest, ctx: LoadedContext, question_filter: EmbeddingDeduper):
+        """
+        Domande della banca per i file del contesto, stessa proporzione di tipi del Builder,
+        diverse per topic ed embedding. Ritorna (domande, tipi delle posizioni rimaste scoperte).
+        """
+        plan = [self._question_type_at(request, i) for i in range(request.num_questions)]
+        query_vector = None
+        if request.custom_prompt.strip():
+            # Con un prompt dell'utente la rilevanza e' la somiglianza con il prompt
+            query_vector = np.asarray(self._embed_text(request.custom_prompt), dtype=np.float32)
+            query_vector /= np.linalg.norm(query_vector) or 1.0
+
+        picked = {}
+        for qtype in dict.fromkeys(plan):
+            questions, vectors, ids = self.question_bank.select(ctx.shards, request.language, qtype, plan.count(qtype),
+                                                                request.max_options, QUESTION_DEDUP_THRESHOLD, query_vector)
+            kept = question_filter.add_unique([q["question"] for q in questions], vectors=vectors)
+            picked[qtype] = [questions[i] for i in kept]
+            # Solo le domande servite davvero: quelle scartate come quasi-duplicati non vanno penalizzate
+            self.question_bank.mark_served([ids[i] for i in kept])
+        # Ordine del Builder (una aperta ogni 5): se un tipo manca, quella posizione resta all'LLM
+        questions, open_types = [], []
+        for qtype in plan:
+            if picked[qtype]: questions.append(picked[qtype].pop(0))
+            else: open_types.append(qtype)
+        return questions, open_types
+
+    def _save_to_bank(self, questions: List[dict], vectors, ctx: LoadedContext, language: str):
+        if self.question_bank is None or not questions: return
+        try:
+            self.question_bank.add(questions, ctx.shards, vectors, language, self._model_name())
+        except Exception as e:
+            print(f"   ⚠️ Could not save questions to the bank: {e}")
 
     def generate_quiz_task(self, job_id: str, request: QuizRequest):
+        # Il contesto resta pinned (niente eviction) finche' il job non termina
+        ctx = self.contexts.acquire(request.context_id)
+        try:
+            self._generate_quiz(job_id, request, ctx)
+        finally:
+            self.contexts.release(ctx)
+
+    def _generate_quiz(self, job_id: str, request: QuizRequest, ctx: Optional[LoadedContext]):
         job_start_time = time.time()
 
         if self._is_cancelled(job_id): return
@@ -164,36 +521,72 @@ class AIEngine:
         
         try:
             # --- START ARCHITECT PHASE ---
-            self.jobs[job_id]["status"] = "processing"
-            self.jobs[job_id]["phase"] = "Extracting Topics (Architect)..." # AGGIORNAMENTO FASE
+            self.jobs.update(job_id, status="processing")
+            self._set_phase(job_id, "Extracting Topics (Architect)...") # AGGIORNAMENTO FASE
             
-            vector_db = self.get_vector_db()
-            if not vector_db: raise Exception("No DB loaded")
+            if ctx is None: raise Exception("No DB loaded")
+            self.jobs.update(job_id, context_id=ctx.id)
 
             if self._is_cancelled(job_id): return
 
-            # 1. Load Model
-            target_model = request.model_id if request.model_id else "balanced"
-            self.load_llm(target_model)
+            embed_fn = self.vector_store.get_embeddings().embed_documents
+            all_questions = []
+            question_filter = EmbeddingDeduper(embed_fn, QUESTION_DEDUP_THRESHOLD)
+            # Tipo di ogni domanda che resta all'LLM (posizione nella sequenza dei topic)
+            type_plan = [self._question_type_at(request, i) for i in range(request.num_questions)]
 
-            if self._is_cancelled(job_id): return
+            # 0. Question Bank: domande gia' validate per questi file, l'LLM genera solo quelle mancanti
+            if request.from_bank and self.question_bank is not None:
+                bank_start = time.time()
+                all_questions, type_plan = self._questions_from_bank(request, ctx, question_filter)
+                PHASE_SECONDS.observe(time.time() - bank_start, "bank")
+                print(f"🏦 Question bank: {len(all_questions)}/{request.num_questions} questions in {time.time() - bank_start:.3f}s")
+                self.jobs.update(job_id, progress=len(all_questions), from_bank=len(all_questions))
+                if all_questions:
+                    self.events.publish(job_id, "questions", {
+                        "progress": len(all_questions),
+                        "total": request.num_questions,
+                        "questions": all_questions,
+                    })
+            needed = request.num_questions - len(all_questions)
+
+            topics_pool = []
+            architect_duration = 0.0
+            if needed > 0:
+                # 1. Load Model
+                target_model = request.model_id if request.model_id else "balanced"
+                self.load_llm(target_model)
 
-            # 2. Architect Phase
-            architect_start = time.time()
-            target_pool_size = 100
-            topics_pool = self.extract_key_topics(vector_db, target_pool_size, request.language)
-            architect_duration = time.time() - architect_start
+                if self._is_cancelled(job_id): return
+
+                # 2. Architect Phase
+                architect_start = time.time()
+                target_pool_size = 100
+                topics_pool = self.get_topic_pool(ctx, target_pool_size, request.language, refresh=request.refresh_topics)
+                architect_duration = time.time() - architect_start
+                PHASE_SECONDS.observe(architect_duration, "architect")
+                if not topics_pool: topics_pool = list(FALLBACK_TOPICS)
+
+                # Topic quasi identici (es. "AES modes" / "Modes of AES") producono le stesse domande;
+                # il filtro parte dai topic gia' coperti dal job (domande prese dalla banca)
+                covered = list(dict.fromkeys(q["topic"] for q in all_questions if q.get("topic")))
+                topic_filter = EmbeddingDeduper(embed_fn, TOPIC_DEDUP_THRESHOLD)
+                topic_filter.seed(covered)
+                fresh = [topics_pool[i] for i in topic_filter.add_unique(topics_pool)]
+                if topic_filter.rejected:
+                    print(f"🧹 Skipped {topic_filter.rejected} topics too close to others or already covered ({len(covered)})")
+                # Banca che copre gia' tutto il pool: meglio ripetere un topic che non generare
+                topics_pool = fresh or topics_pool
             
-            print(f"\n📋 ARCHITECT POOL ({len(topics_pool)} candidates in {architect_duration:.1f}s):")
-            for i, t in enumerate(topics_pool):
-                print(f"   {i+1}. {t}")
-            print("-" * 30)
+                print(f"\n📋 ARCHITECT POOL ({len(topics_pool)} candidates in {architect_duration:.1f}s):")
+                for i, t in enumerate(topics_pool):
+                    print(f"   {i+1}. {t}")
+                print("-" * 30)
             
             # --- START BUILDER PHASE ---
-            self.jobs[job_id]["phase"] = "Generating Questions (Builder)..." # AGGIORNAMENTO FASE
+            self._set_phase(job_id, "Generating Questions (Builder)...") # AGGIORNAMENTO FASE
             
             # 3. Prepare Batch List
-            needed = request.num_questions
             selected_topics_sequence = []
             
             while len(selected_topics_sequence) < needed:
@@ -202,192 +595,323 @@ class AIEngine:
             
             selected_topics_sequence = selected_topics_sequence[:needed]
             
+            # Retrieval per tutti i topic in una sola chiamata (embedding a matrice + search unica)
+            retrieval_start = time.time()
+            topic_docs = dict(zip(selected_topics_sequence, self.retrieve_many(ctx, selected_topics_sequence, k=3)))
+            PHASE_SECONDS.observe(time.time() - retrieval_start, "retrieval")
+            print(f"🔎 Retrieved context for {len(topic_docs)} topics in {time.time() - retrieval_start:.2f}s")
+
             parser = PydanticOutputParser(pydantic_object=AIQuizOutput)
-            all_questions = []
-            generated_hashes = []
             generated_concepts_history = []
+            batch_timings = []
             
-            # 4. Builder Phase
+            # 4. Builder Phase (batch in parallelo su un pool limitato)
             builder_start = time.time()
-            TOPIC_BATCH_SIZE = 10
-            topic_batches = [selected_topics_sequence[i:i + TOPIC_BATCH_SIZE] for i in range(0, len(selected_topics_sequence), TOPIC_BATCH_SIZE)]
-            
-            for batch_idx, batch_topics in enumerate(topic_batches):
+            refine_overhead = estimate_tokens(parser.get_format_instructions()) + 150
+            max_topics = max_topics_per_batch(self.ctx_size, refine_overhead, TOPIC_BATCH_SIZE)
+            topic_batches = pack_batches(selected_topics_sequence, topic_docs, self.ctx_size, max_topics)
+            print(f"📦 Packed {len(selected_topics_sequence)} topics into {len(topic_batches)} batches "
+                  f"(num_ctx: {self.ctx_size}, max {max_topics} topics/batch)")
+            concurrency = max(1, request.concurrency or BUILDER_CONCURRENCY)
+            llm = self.llm
+            print(f"⚙️  Builder concurrency: {concurrency}")
 
-                if self._is_cancelled(job_id): return
+            pool = ThreadPoolExecutor(max_workers=concurrency)
+            in_flight = {}
+            next_batch = 0
+            try:
+                while next_batch < len(topic_batches) or in_flight:
+                    if self._is_cancelled(job_id): return
 
-                if len(all_questions) >= request.num_questions: break
-                
-                print(f"\n🧱 [BUILDER] Batch {batch_idx + 1}/{len(topic_batches)}")
-                
-                batch_start_time = time.time()
-                
-                # Mixed Logic
-                type_instructions = []
-                for i in range(len(batch_topics)):
-                    # Mixed Logic
-                    if request.question_type == 'mixed':
-                        # Una Open Ended ogni 5, il resto Multiple Choice
-                        target_type = "open_ended" if (len(all_questions) + i + 1) % 5 == 0 else "multiple_choice"
-                    elif "aperta" in request.question_type or "open" in request.question_type:
-                         target_type = "open_ended"
-                    else:
-                         target_type = "multiple_choice"
-                    
-                    type_instructions.append(f"- Question {i+1} Type: {target_type}")
-
-                type_constraints_str = "\n".join(type_instructions)
-
-                # Context Retrieval
-                multi_context_str = ""
-                sources_map = {} 
-                
-                for idx, t in enumerate(batch_topics):
-                    retriever = vector_db.as_retriever(search_kwargs={'k': 3})
-                    docs = retriever.invoke(t)
-                    t_ctx = "\n".join([d.page_content for d in docs])
-                    multi_context_str += f"\n--- TOPIC {idx+1}: {t} ---\nSOURCE MATERIAL:\n{t_ctx}\n"
-                    if docs:
-                        sources_map[t] = docs[0].metadata.get('source', 'Unknown')
-
-                history_window = generated_concepts_history[-20:]
-                history_str = "; ".join(history_window) if history_window else "None"
-                
-                try:
-                    draft_prompt = ChatPromptTemplate.from_template("""
-                    Role: Technical Expert.
-                    Task: Generate exactly {qty} quiz questions based on the provided context.
-                    
-                    CONTEXT:
-                    {context}
-                    
-                    REQUIREMENTS:
-                    1. Output Format: JSON List.
-                    2. Language of Content: {lang} (Questions and Answers must be in {lang}).
-                    3. JSON KEYS MUST BE IN ENGLISH: "question", "type", "options", "answer", "explanation".
-                    4. "type" values must be strictly: "multiple_choice" or "open_ended".
-                    5. For "multiple_choice", generate EXACTLY {max_opts} options.
-                    
-                    SPECIFIC TYPES:
-                    {type_constraints}
-                    
-                    Output only the raw JSON.
-                    """)
-                    
-                    draft_chain = draft_prompt | self.llm | StrOutputParser()
-                    raw_draft = draft_chain.invoke({
-                        "qty": len(batch_topics),
-                        "context": multi_context_str,
-                        "type_constraints": type_constraints_str,
-                        "lang": request.language,
-                        "max_opts": request.max_options 
-                    })
-                    
-                    refine_prompt = ChatPromptTemplate.from_template("""
-                    Role: JSON Editor.
-                    Task: Validate and Format JSON.
-                    Input Draft: {draft}
-                    
-                    RULES:
-                    1. JSON Keys: "question", "type", "options", "answer", "explanation".
-                    2. Content Language: {lang}.
-                    3. "type" MUST be "multiple_choice" or "open_ended".
-                    4. "answer" must be the exact text of the correct option.
-                    
-                    Format:
-                    {format_instructions}
-                    """)
+                    while (next_batch < len(topic_batches) and len(in_flight) < concurrency
+                           and len(all_questions) < request.num_questions):
+                        history_window = generated_concepts_history[-20:]
+                        fut = pool.submit(self._build_batch, job_id, request, llm, parser,
+                                          topic_batches[next_batch], len(topic_batches), history_window, type_plan)
+                        in_flight[fut] = next_batch
+                        next_batch += 1
 
-                    if self._is_cancelled(job_id): return
-                    
-                    refine_chain = refine_prompt | self.llm | StrOutputParser()
-                    json_str_output = refine_chain.invoke({
-                        "draft": raw_draft,
-                        "lang": request.language,
-                        "format_instructions": parser.get_format_instructions()
-                    })
-                    
-                    cleaned_json = clean_json_output(json_str_output)
-                    try:
-                        parsed_data = json.loads(cleaned_json)
-                    except json.JSONDecodeError:
-                        print("     ❌ JSON Error. Skipping.")
-                        continue 
-                        
-                    if isinstance(parsed_data, list):
-                        parsed_data = {"questions": parsed_data}
-
-                    if "questions" in parsed_data and isinstance(parsed_data["questions"], list):
-                         for q in parsed_data["questions"]:
-                            if "corretta" in q and isinstance(q["corretta"], (int, float)):
-                                q["corretta"] = str(q["corretta"])
-                            if "opzioni" in q and isinstance(q["opzioni"], list):
-                                clean_opts = []
-                                for opt in q["opzioni"]:
-                                    if isinstance(opt, dict):
-                                        val = opt.get('text') or opt.get('value') or list(opt.values())[0]
-                                        clean_opts.append(str(val))
-                                    else:
-                                        clean_opts.append(str(opt))
-                                q["opzioni"] = clean_opts
-                        
-                    structured_output = AIQuizOutput.model_validate(parsed_data)
-                    
-                    valid_batch_count = 0
-                    for i, q in enumerate(structured_output.questions):
-                        if q.question in generated_hashes: continue
-                        
-                        q_dict = {
-                            "question": q.question,       
-                            "type": q.type,               
-                            "options": q.options,         
-                            "answer": q.answer,           
-                            "explanation": q.explanation, 
-                            "source_file": sources_map.get(batch_topics[i] if i < len(batch_topics) else batch_topics[-1], 'Unknown')
-                        }
-                        
-                        all_questions.append(q_dict)
-                        generated_hashes.append(q.question)
-                        generated_concepts_history.append(q.question[:60])
-                        valid_batch_count += 1
-                    
-                    batch_duration = time.time() - batch_start_time
-                    print(f"     ✅ Batch: +{valid_batch_count} Qs ({batch_duration:.1f}s)")
-                    
-                    self.jobs[job_id]["progress"] = len(all_questions)
+                    if not in_flight: break
 
-                except Exception as e:
-                    print(f"     ❌ Batch Error: {e}")
-                    continue
+                    # Timeout breve: il controllo di cancellazione resta reattivo
+                    done, _ = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        in_flight.pop(fut)
+                        batch_questions, timing = fut.result()
+                        if timing:
+                            batch_timings.append(timing)
+                            self.jobs.update(job_id, batch_timings=batch_timings)
+                        if batch_questions is None or self._is_cancelled(job_id): continue
+
+                        # Scarta le parafrasi di domande gia' accettate (coseno sugli embedding)
+                        kept = question_filter.add_unique([q["question"] for q in batch_questions],
+                                                          limit=request.num_questions - len(all_questions))
+                        new_questions = [batch_questions[i] for i in kept]
+                        all_questions.extend(new_questions)
+                        self._save_to_bank(new_questions, question_filter.last_vectors, ctx, request.language)
+                        generated_concepts_history.extend(q["question"][:60] for q in new_questions)
+
+                        self.jobs.update(job_id, progress=len(all_questions), near_duplicates=question_filter.rejected)
+                        # Le domande validate vanno subito allo stream: si puo' studiare dal primo batch
+                        self.events.publish(job_id, "questions", {
+                            "progress": len(all_questions),
+                            "total": request.num_questions,
+                            "questions": new_questions,
+                        })
+            finally:
+                # Non si aspettano i batch in volo: /quiz/stop deve liberare subito il job
+                pool.shutdown(wait=False, cancel_futures=True)
 
             if self._is_cancelled(job_id): return
 
             builder_duration = time.time() - builder_start
             total_duration = time.time() - job_start_time
+            PHASE_SECONDS.observe(builder_duration, "builder")
+            PHASE_SECONDS.observe(total_duration, "generation")
             
             print(f"\n{'='*60}")
             print(f"🏁 WORKFLOW COMPLETED")
-            print(f"📊 Stats: {len(all_questions)} Qs in {total_duration:.2f}s")
+            print(f"📊 Stats: {len(all_questions)} Qs in {total_duration:.2f}s ({question_filter.rejected} near-duplicates dropped)")
+            self._print_timing_summary(batch_timings)
             print(f"{'='*60}\n")
 
-            self.jobs[job_id]["result"] = all_questions[:request.num_questions]
-            self.jobs[job_id]["status"] = "completed"
+            result = all_questions[:request.num_questions]
+            self.jobs.update(job_id, result=result, status="completed")
+            self.events.publish(job_id, "completed", {"progress": len(result)})
                 
         except Exception as e:
             # 8. EXCEPTION HANDLER (Evita di sovrascrivere "cancelled" con "failed")
-            if self.jobs[job_id]["status"] != "cancelled":
+            if self.jobs.get_status(job_id) != "cancelled":
                 print(f"\n❌ [FATAL ERROR] {e}")
-                self.jobs[job_id]["status"] = "failed"
-                self.jobs[job_id]["error"] = str(e)
+                self.jobs.update(job_id, status="failed", error=str(e))
+                self.events.publish(job_id, "failed", {"error": str(e)})
             else:
                 print(f"\n⛔ Exception ignored because job was cancelled.")
 
-    def get_chat_response(self, question: str, lang: str):
-        vector_db = self.get_vector_db()
-        if not vector_db: return "Context not found. Please upload a file."
+    def _print_timing_summary(self, timings: List[dict]):
+        done = [t for t in timings if "total_s" in t]
+        if not done: return
+        avg = sum(t["total_s"] for t in done) / len(done)
+        fallbacks = sum(1 for t in timings if t.get("fallback"))
+        print(f"⏱️  Batch avg: {avg:.1f}s over {len(done)} batches (mode: {done[0]['mode']}, fallbacks: {fallbacks})")
+        salvaged = sum(t.get("salvaged", 0) for t in timings)
+        if salvaged: print(f"🩹 Re-requested questions recovered: {salvaged}")
+        tokens = [t["prompt_tokens"] for t in timings if "prompt_tokens" in t]
+        if tokens: print(f"🧮 Prompt tokens per batch: avg {sum(tokens) // len(tokens)}, max {max(tokens)} (num_ctx: {self.ctx_size})")
+
+    def _build_batch(self, job_id: str, request: QuizRequest, llm, parser, batch: PackedBatch, total_batches: int,
+                     history_window: List[str], type_plan: List[str]):
+        """
+        Genera un batch di domande (gira nel pool del Builder). Ritorna (domande | None, tempi).
+        type_plan[i] = tipo della domanda per il topic i della sequenza (batch.start + posizione).
+        """
+        if self._is_cancelled(job_id): return None, None
+        batch_idx = batch.index
+        batch_topics = batch.topics
+
+        print(f"\n🧱 [BUILDER] Batch {batch_idx + 1}/{total_batches}")
+        batch_start_time = time.time()
+
+        # Mixed Logic
+        type_instructions = []
+        for i in range(len(batch_topics)):
+            target_type = type_plan[batch.start + i]
+            type_instructions.append(f"- Question {i+1} Type: {target_type}")
+
+        type_constraints_str = "\n".join(type_instructions)
+
+        # Context (gia' recuperato e deduplicato dal packer)
+        multi_context_str = batch.context
+        sources_map = batch.sources
+
+        history_str = "; ".join(history_window) if history_window else "None"
         
-        docs = vector_db.as_retriever(search_kwargs={'k': 6}).invoke(question)
-        ctx = "\n".join([d.page_content for d in docs])
+        timing = {"batch": batch_idx + 1, "mode": request.generation_mode, "topics": len(batch_topics),
+                  "context_tokens": batch.context_tokens, "deduped_chunks": batch.deduped_chunks}
+        try:
+            draft_prompt = ChatPromptTemplate.from_template("""
+            Role: Technical Expert.
+            Task: Generate exactly {qty} quiz questions based on the provided context.
+            
+            CONTEXT:
+            {context}
+            
+            REQUIREMENTS:
+            1. Output Format: {output_format}
+            2. Language of Content: {lang} (Questions and Answers must be in {lang}).
+            3. JSON KEYS MUST BE IN ENGLISH: "question", "type", "options", "answer", "explanation".
+            4. "type" values must be strictly: "multiple_choice" or "open_ended".
+            5. For "multiple_choice", generate EXACTLY {max_opts} options.
+            
+            SPECIFIC TYPES:
+            {type_constraints}
+            
+            Output only the raw JSON.
+            """)
+            draft_inputs = {
+                "qty": len(batch_topics),
+                "context": multi_context_str,
+                "type_constraints": type_constraints_str,
+                "lang": request.language,
+                "max_opts": request.max_options 
+            }
+            timing["prompt_tokens"] = estimate_tokens(draft_prompt.format(**draft_inputs, output_format=DRAFT_OUTPUT_FORMAT))
+
+            structured_output, positions = None, []
+            if request.generation_mode == "single_pass":
+                # Una sola chiamata: Ollama vincola l'output allo schema JSON di AIQuizOutput
+                t0 = time.time()
+                structured_chain = draft_prompt | llm.bind(format=QUIZ_JSON_SCHEMA) | StrOutputParser()
+                raw_draft = structured_chain.invoke({**draft_inputs, "output_format": STRUCTURED_OUTPUT_FORMAT},
+                                                    config={"tags": ["structured"]})
+                timing["structured_s"] = round(time.time() - t0, 2)
+                try:
+                    structured_output, positions = self._parse_quiz_output(raw_draft)
+                except Exception as e:
+                    # Fallback: il refine riformatta l'output non valido
+                    print(f"     ⚠️ Structured output invalid (batch {batch_idx + 1}): {e}. Falling back to refine.")
+                    timing["fallback"] = True
+            else:
+                t0 = time.time()
+                draft_chain = draft_prompt | llm | StrOutputParser()
+                raw_draft = draft_chain.invoke({**draft_inputs, "output_format": DRAFT_OUTPUT_FORMAT}, config={"tags": ["draft"]})
+                timing["draft_s"] = round(time.time() - t0, 2)
+
+            if structured_output is None:
+                refine_prompt = ChatPromptTemplate.from_template("""
+                Role: JSON Editor.
+                Task: Validate and Format JSON.
+                Input Draft: {draft}
+                
+                RULES:
+                1. JSON Keys: "question", "type", "options", "answer", "explanation".
+                2. Content Language: {lang}.
+                3. "type" MUST be "multiple_choice" or "open_ended".
+                4. "answer" must be the exact text of the correct option.
+                
+                Format:
+                {format_instructions}
+                """)
+
+                if self._is_cancelled(job_id): return None, timing
+                
+                t0 = time.time()
+                refine_chain = refine_prompt | llm | StrOutputParser()
+                json_str_output = refine_chain.invoke({
+                    "draft": raw_draft,
+                    "lang": request.language,
+                    "format_instructions": parser.get_format_instructions()
+                }, config={"tags": ["refine"]})
+                timing["refine_s"] = round(time.time() - t0, 2)
+                
+                try:
+                    structured_output, positions = self._parse_quiz_output(json_str_output)
+                except ValueError:
+                    # Niente di recuperabile: tutte le posizioni risultano mancanti e passano dal re-request
+                    print(f"     ❌ JSON Error (batch {batch_idx + 1}): no valid question.")
+
+            # Salvataggio parziale: si tengono le domande valide e si richiedono solo i topic rimasti scoperti
+            questions = list(zip(positions, structured_output.questions)) if structured_output is not None else []
+            for _ in range(SALVAGE_RETRIES):
+                missing = sorted(set(range(len(batch_topics))) - set(positions))
+                if not missing or self._is_cancelled(job_id): break
+                print(f"     🩹 Batch {batch_idx + 1}: {len(positions)} valid Qs, re-requesting {len(missing)}")
+                recovered = self._request_missing(request, llm, draft_prompt, batch, missing, type_plan, timing)
+                questions.extend(recovered)
+                positions.extend(p for p, _ in recovered)
+                timing["salvaged"] = timing.get("salvaged", 0) + len(recovered)
+            if not questions:
+                print(f"     ❌ Batch {batch_idx + 1}: no valid question after re-request. Skipping.")
+                return None, timing
+            questions.sort(key=lambda item: item[0])
+
+            batch_questions = []
+            for i, q in questions:
+                topic = batch_topics[i] if i < len(batch_topics) else batch_topics[-1]
+                q_dict = {
+                    "question": q.question,       
+                    "type": q.type,               
+                    "options": q.options,         
+                    "answer": q.answer,           
+                    "explanation": q.explanation, 
+                    "source_file": sources_map.get(topic, 'Unknown'),
+                    "topic": topic
+                }
+                batch_questions.append(q_dict)
+            
+            batch_duration = time.time() - batch_start_time
+            timing["total_s"] = round(batch_duration, 2)
+            print(f"     ✅ Batch {batch_idx + 1}: +{len(batch_questions)} Qs ({batch_duration:.1f}s)")
+            return batch_questions, timing
+
+        except Exception as e:
+            print(f"     ❌ Batch Error: {e}")
+            return None, timing
+
+    def _request_missing(self, request: QuizRequest, llm, draft_prompt, batch: PackedBatch, missing: List[int],
+                         type_plan: List[str], timing: dict) -> list:
+        """Una chiamata strutturata per i soli topic senza domanda valida: [(posizione nel batch, AIQuestion)]."""
+        focus = ", ".join(f"TOPIC {i + 1} ({batch.topics[i]})" for i in missing)
+        inputs = {
+            "qty": len(missing),
+            "context": f"{batch.context}\nFOCUS ONLY ON: {focus}",
+            "type_constraints": "\n".join(f"- Question {n + 1} Type: {type_plan[batch.start + i]}"
+                                          for n, i in enumerate(missing)),
+            "lang": request.language,
+            "max_opts": request.max_options,
+            "output_format": STRUCTURED_OUTPUT_FORMAT,
+        }
+        t0 = time.time()
+        try:
+            chain = draft_prompt | llm.bind(format=QUIZ_JSON_SCHEMA) | StrOutputParser()
+            output, positions = self._parse_quiz_output(chain.invoke(inputs, config={"tags": ["salvage"]}))
+        except Exception as e:
+            print(f"     ⚠️ Re-request failed (batch {batch.index + 1}): {e}")
+            return []
+        finally:
+            timing["salvage_s"] = round(timing.get("salvage_s", 0) + time.time() - t0, 2)
+        # Le posizioni della risposta si riferiscono ai soli topic mancanti
+        return [(missing[p], q) for p, q in zip(positions, output.questions) if p < len(missing)]
+
+    @staticmethod
+    def _is_question_item(obj: dict) -> bool:
+        # Non basta la chiave "question": le properties dello schema ripetute dal modello hanno "question": {...}
+        return isinstance(obj.get("question"), str) and ("answer" in obj or "type" in obj)
+
+    def _parse_quiz_output(self, text: str):
+        """
+        JSON grezzo dell'LLM -> (AIQuizOutput con le sole domande valide, posizione di ognuna nell'output).
+        Ogni domanda e' estratta e validata da sola: un item rotto o troncato, o un involucro
+        non valido, non fanno scartare le altre. Solleva ValueError se non ne resta nessuna.
+        """
+        with timed("json_parse"):
+            # La posizione di un item = quante chiavi "question" (con un valore che non sia un oggetto)
+            # lo precedono: le domande perse non spostano le altre, che restano associate al loro topic
+            stream = JsonItemStream(self._is_question_item, marker=r'"question"\s*:\s*(?=[^\s{])')
+            stream.feed(text)
+            stream.close()
+            items = stream.numbered()
+            questions, positions = [], []
+            for i, item in items:
+                try:
+                    questions.append(AIQuestion.model_validate(item))
+                    positions.append(i)
+                except ValidationError:
+                    continue
+        invalid = len(items) - len(questions)
+        if invalid: JSON_PARSE.inc("question", "invalid", amount=invalid)
+        if not questions:
+            JSON_PARSE.inc("quiz", "failed")
+            raise ValueError("No valid question in the LLM output")
+        # "salvaged": item non validi o persi (buchi nelle posizioni) ma almeno una domanda recuperata
+        JSON_PARSE.inc("quiz", "salvaged" if invalid or positions[-1] >= len(positions) else "ok")
+        return AIQuizOutput(questions=questions), positions
+
+    def _chat_chain(self, question: str, lang: str, ctx: Optional[LoadedContext]):
+        if ctx is None: return None, None
+        
+        docs = self.retrieve_many(ctx, [question], k=6)[0]
+        context_text = "\n".join([d.page_content for d in docs])
         
         # PROMPT AGGIORNATO: Usa la variabile {lang}
         prompt = ChatPromptTemplate.from_template("""
@@ -400,10 +924,78 @@ class AIEngine:
         IMPORTANT: Answer in {lang}.
         """)
         
-        chain = prompt | self.llm | StrOutputParser()
-        return chain.invoke({"ctx": ctx, "q": question, "lang": lang})
+        chain = prompt | self._get_llm() | StrOutputParser()
+        return chain, {"ctx": context_text, "q": question, "lang": lang}
+
+    def _chat_cache_key(self, question: str, lang: str, context_id: Optional[str]):
+        # Il fingerprint viene dal catalogo: un hit non ricarica un contesto scaricato
+        fingerprint = self.contexts.fingerprint(context_id)
+        if not fingerprint: return None, None
+        # Il modello va risolto prima della chiave: in modalita' lazy current_model_id e' ancora "default"
+        self._get_llm()
+        scope = make_key("chat", self._model_name(), fingerprint, lang)
+        return make_key(scope, normalize_text(question)), scope
+
+    def get_chat_response(self, question: str, lang: str, context_id: Optional[str] = None):
+        key, scope = self._chat_cache_key(question, lang, context_id)
+        if key:
+            cached = self.chat_cache.lookup(key, scope, normalize_text(question))
+            if cached is not None: return cached
+
+        with self.contexts.use(context_id) as ctx:
+            chain, inputs = self._chat_chain(question, lang, ctx)
+        if chain is None: return CONTEXT_MISSING_MSG
+        start = time.time()
+        answer = chain.invoke(inputs, config={"tags": ["chat"]})
+        print(f"💬 Chat answered in {time.time() - start:.2f}s")
+        if key and answer: self.chat_cache.store(key, answer, scope, normalize_text(question))
+        return answer
+
+    def stream_chat_response(self, question: str, lang: str, context_id: Optional[str] = None):
+        """Generatore di eventi ("token", testo) e infine ("done", tempi) per /chat/stream."""
+        start = time.time()
+        key, scope = self._chat_cache_key(question, lang, context_id)
+        if key:
+            cached = self.chat_cache.lookup(key, scope, normalize_text(question))
+            if cached is not None:
+                elapsed = round(time.time() - start, 3)
+                yield "token", cached
+                yield "done", {"first_token_s": elapsed, "total_s": elapsed, "cached": True}
+                return
+
+        with self.contexts.use(context_id) as ctx:
+            chain, inputs = self._chat_chain(question, lang, ctx)
+        if chain is None:
+            yield "token", CONTEXT_MISSING_MSG
+            yield "done", {"first_token_s": 0.0, "total_s": 0.0}
+            return
+
+        first_token_s = None
+        parts = []
+        for token in chain.stream(inputs, config={"tags": ["chat"]}):
+            if not token: continue
+            if first_token_s is None: first_token_s = time.time() - start
+            parts.append(token)
+            yield "token", token
+
+        stats = {"first_token_s": round(first_token_s or 0.0, 3), "total_s": round(time.time() - start, 3)}
+        print(f"💬 Chat streamed: first token {stats['first_token_s']}s, total {stats['total_s']}s")
+        if key and parts: self.chat_cache.store(key, "".join(parts), scope, normalize_text(question))
+        yield "done", stats
+
+    def _grade_cache_key(self, q, c, u, l):
+        self._get_llm()   # come _chat_cache_key: la chiave usa il modello effettivo
+        scope = make_key("grade", self._model_name(), q, c, l)
+        return make_key(scope, normalize_text(u)), scope, normalize_text(u)
 
     def grade_answer(self, q, c, u, l):
+        # Stessa domanda + stessa risposta (normalizzata) = stesso voto, senza chiamare l'LLM
+        key, scope, norm_u = self._grade_cache_key(q, c, u, l)
+        cached = self.grade_cache.lookup(key, scope, norm_u)
+        if cached is not None:
+            print(f"⚖️ Grading served from cache")
+            return cached
+
         print(f"⚖️ Grading Answer... Language: {l}")
         
         # PROMPT AGGIORNATO: "Benevolent Professor"
@@ -416,13 +1008,7 @@ class AIEngine:
         Reference/Correct Answer: "{c}"
         User Answer: "{u}"
         Output Language: {l}
-        
-        GRADING RULES:
-        1. **IGNORE Typos & Grammar:** Do NOT penalize spelling mistakes (e.g., "algortmo", "perche", missing accents) unless the answer is completely unreadable. Focus ONLY on the meaning.
-        2. **Semantic Match:** If the user conveys the core concept correctly, give a HIGH score (90-100), even if the phrasing is informal.
-        3. **Technical Accuracy:** If the user mentions correct advanced concepts (like Shannon's Theorem, K >= M, etc.) that are relevant, REWARD them, do not criticize them for being "brief".
-        4. **Feedback Tone:** Be encouraging. If the answer is correct but has typos, mention the typos gently in the feedback but DO NOT lower the score for them.
-        
+        """ + GRADING_RULES + """
         OUTPUT FORMAT (JSON):
         {{
             "score": <int 0-100>,
@@ -431,19 +1017,129 @@ class AIEngine:
         }}
         """)
         
-        chain = prompt | self.llm | StrOutputParser()
+        chain = prompt | self._get_llm() | StrOutputParser()
         
         try:
-            res = chain.invoke({"q": q, "c": c, "u": u, "l": l})
+            res = chain.invoke({"q": q, "c": c, "u": u, "l": l}, config={"tags": ["grade"]})
             cleaned_json = clean_json_output(res)
-            return json.loads(cleaned_json)
+            result = json.loads(cleaned_json)
+            JSON_PARSE.inc("grade", "ok")
+            self.grade_cache.store(key, result, scope, norm_u)
+            return result
         except Exception as e:
+            if isinstance(e, ValueError): JSON_PARSE.inc("grade", "failed")
             print(f"   ❌ Grading Error: {e}")
             return {
                 "score": 0, 
                 "feedback": "Error evaluating answer. Please try again.", 
                 "ideal_answer": c
             }
+
+    def grade_answers_batch(self, items: list) -> List[dict]:
+        """
+        Valuta una consegna intera: le risposte brevi vengono impacchettate in un
+        unico prompt (finche' stanno nel contesto del modello), il resto va in
+        parallelo. Ogni item fallisce da solo, l'ordine del risultato e' quello di `items`.
+        """
+        start = time.time()
+        results = [None] * len(items)
+        pending = []
+        for idx, it in enumerate(items):
+            key, scope, norm_u = self._grade_cache_key(it.question, it.correct_answer, it.user_answer, it.language)
+            cached = self.grade_cache.lookup(key, scope, norm_u)
+            if cached is not None: results[idx] = cached
+            else: pending.append(idx)
+
+        # Pacchetti di risposte brevi, per lingua, entro il budget di token
+        input_budget = self.ctx_size // 2
+        groups, singles = [], []
+        by_lang = {}
+        for idx in pending:
+            it = items[idx]
+            cost = estimate_tokens(it.question + it.correct_answer + it.user_answer) + GRADE_OUTPUT_TOKENS
+            if cost > GRADE_PACK_ITEM_TOKENS: singles.append(idx)
+            else: by_lang.setdefault(it.language, []).append((idx, cost))
+        for lang_items in by_lang.values():
+            group, used = [], 0
+            for idx, cost in lang_items:
+                if group and (len(group) >= GRADE_PACK_MAX or used + cost > input_budget):
+                    groups.append(group)
+                    group, used = [], 0
+                group.append(idx)
+                used += cost
+            if len(group) == 1: singles.extend(group)
+            elif group: groups.append(group)
+
+        def run_single(idx):
+            it = items[idx]
+            results[idx] = self.grade_answer(it.question, it.correct_answer, it.user_answer, it.language)
+
+        def run_group(group):
+            try:
+                packed = self._grade_packed([items[i] for i in group])
+            except Exception as e:
+                print(f"   ⚠️ Packed grading failed ({e}), grading items one by one.")
+                packed = {}
+            for pos, idx in enumerate(group):
+                if pos in packed: results[idx] = packed[pos]
+                else: run_single(idx)
+
+        with ThreadPoolExecutor(max_workers=max(1, BUILDER_CONCURRENCY)) as pool:
+            futures = [pool.submit(run_group, g) for g in groups] + [pool.submit(run_single, i) for i in singles]
+            for fut in futures:
+                try: fut.result()
+                except Exception as e: print(f"   ❌ Grading Error: {e}")
+
+        for idx, it in enumerate(items):
+            if results[idx] is None:
+                results[idx] = {"score": 0, "feedback": "Error evaluating answer. Please try again.", "ideal_answer": it.correct_answer}
+        print(f"⚖️ Graded {len(items)} answers ({len(groups)} packed prompts, {len(singles)} single) in {time.time() - start:.1f}s")
+        return results
+
+    def _grade_packed(self, group: list) -> dict:
+        """Un solo prompt per piu' risposte. Ritorna {posizione: voto} per gli item validi."""
+        lang = group[0].language
+        blocks = []
+        for pos, it in enumerate(group):
+            blocks.append(f'ITEM {pos + 1}:\nQuestion: "{it.question}"\nReference/Correct Answer: "{it.correct_answer}"\nUser Answer: "{it.user_answer}"')
+
+        prompt = ChatPromptTemplate.from_template("""
+        Role: Fair & Expert Examiner.
+        Task: Grade EACH user's answer below (0-100) based on its correct answer/context.
+        Output Language: {l}
+        
+        {items}
+        """ + GRADING_RULES + """
+        OUTPUT FORMAT (JSON, one entry per ITEM, same order):
+        {{
+            "grades": [
+                {{"item": <int>, "score": <int 0-100>, "feedback": "<string in {l}>", "ideal_answer": "<string in {l}>"}}
+            ]
+        }}
+        """)
+        chain = prompt | self._get_llm() | StrOutputParser()
+        res = chain.invoke({"items": "\n\n".join(blocks), "l": lang}, config={"tags": ["grade_batch"]})
+        try:
+            data = json.loads(clean_json_output(res))
+        except ValueError:
+            JSON_PARSE.inc("grade_batch", "failed")
+            raise
+        JSON_PARSE.inc("grade_batch", "ok")
+        grades = data.get("grades", []) if isinstance(data, dict) else data
+
+        packed = {}
+        for g in grades:
+            try:
+                pos = int(g.get("item")) - 1
+                if not 0 <= pos < len(group) or pos in packed: continue
+                result = {"score": int(g["score"]), "feedback": str(g.get("feedback", "")), "ideal_answer": str(g.get("ideal_answer", ""))}
+            except Exception:
+                continue
+            it = group[pos]
+            key, scope, norm_u = self._grade_cache_key(it.question, it.correct_answer, it.user_answer, it.language)
+            self.grade_cache.store(key, result, scope, norm_u)
+            packed[pos] = result
+        return packed
         
     def regenerate_question(self, current_question_text, instruction, lang):
         print(f"♻️ Regenerating: {current_question_text[:30]}... | Instr: {instruction}")
@@ -474,10 +1170,10 @@ class AIEngine:
         4. Output valid JSON only. NO Markdown code blocks.
         """)
         
-        chain = prompt | self.llm | StrOutputParser()
+        chain = prompt | self._get_llm() | StrOutputParser()
         
         try:
-            raw_res = chain.invoke({"q": current_question_text, "i": instruction, "l": lang})
+            raw_res = chain.invoke({"q": current_question_text, "i": instruction, "l": lang}, config={"tags": ["regenerate"]})
             cleaned_json = clean_json_output(raw_res)
             data = json.loads(cleaned_json)
 
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+from typing import Optional
+
+import numpy as np
+
+# --- CONFIGURAZIONE INDICE ---
+# "auto" sceglie in base al numero di chunk; "flat" | "hnsw" | "ivf" | "pq" forzano il tipo
+INDEX_TYPE = os.environ.get("QUIZ_INDEX_TYPE", "auto")
+AUTO_FLAT_MAX = int(os.environ.get("QUIZ_INDEX_FLAT_MAX", "5000"))      # sotto: ricerca esatta
+AUTO_HNSW_MAX = int(os.environ.get("QUIZ_INDEX_HNSW_MAX", "100000"))    # sopra: IVF-PQ (memoria ridotta)
+HNSW_M = 32
+HNSW_EF_SEARCH = 128
+PQ_BYTES = 48               # byte per vettore (384 dim MiniLM -> 8 dimensioni per sotto-quantizzatore)
+PQ_MIN_TRAIN = 256 * 39     # punti minimi per addestrare codebook a 8 bit
+REPORT_QUERIES = int(os.environ.get("QUIZ_INDEX_REPORT_QUERIES", "200"))
+REPORT_K = 10
+# Indici ANN salvati su disco (uno per contesto): oltre questo numero si eliminano i meno usati
+ANN_CACHE_MAX = int(os.environ.get("QUIZ_ANN_CACHE_MAX", "8"))
+ANN_PREFIX = "ann_"
+ANN_CACHE_VERSION = 3       # v2: shard uniti in ordine di chiave; v3: recall misurata su query non indicizzate
+
+
+def choose_index_type(n: int) -> str:
+    kind = INDEX_TYPE if INDEX_TYPE != "auto" else (
+        "flat" if n <= AUTO_FLAT_MAX else "hnsw" if n <= AUTO_HNSW_MAX else "pq")
+    if kind == "pq" and n < PQ_MIN_TRAIN: kind = "ivf"
+    if kind == "ivf" and n < 1000: kind = "flat"   # troppo pochi punti per addestrare le liste
+    return kind
+
+
+def build_index(vectors: np.ndarray, kind: str):
+    import faiss
+    n, d = vectors.shape
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M)
+        index.hnsw.efConstruction = 80
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif kind in ("ivf", "pq"):
+        nlist = max(8, int(4 * np.sqrt(n)))
+        quantizer = faiss.IndexFlatL2(d)
+        if kind == "pq" and d % PQ_BYTES == 0:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, PQ_BYTES, 8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        index.train(vectors)
+        index.nprobe = max(8, nlist // 16)
+    else:
+        index = faiss.IndexFlatL2(d)
+    index.add(vectors)
+    return index
+
+
+def report_queries(vectors: np.ndarray, count: int = REPORT_QUERIES, seed: int = 0) -> np.ndarray:
+    """
+    Query sintetiche che non coincidono con nessun vettore indicizzato: punto medio di due
+    chunk a caso + rumore gaussiano. Con i vettori stessi come query il primo vicino e'
+    sempre la query (recall gonfiata, es. HNSW a 1.0).
+    """
+    rng = np.random.default_rng(seed)
+    n, d = vectors.shape
+    count = min(count, n)
+    a = vectors[rng.integers(0, n, count)]
+    b = vectors[rng.integers(0, n, count)]
+    scale = float(np.std(vectors)) or 1.0
+    queries = (a + b) / 2 + rng.normal(0, scale * 0.5, size=(count, d)).astype(np.float32)
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def recall_report(vectors: np.ndarray, index, k: int = REPORT_K) -> dict:
+    """Recall@k e latenza dell'indice approssimato rispetto alla ricerca esatta (flat), su query non indicizzate."""
+    import faiss
+    n = len(vectors)
+    queries = report_queries(vectors)
+    k = min(k, n)
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    t0 = time.time()
+    _, truth = flat.search(queries, k)
+    flat_ms = (time.time() - t0) * 1000 / len(queries)
+    t0 = time.time()
+    _, found = index.search(queries, k)
+    ann_ms = (time.time() - t0) * 1000 / len(queries)
+
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return {
+        "recall_at_k": round(hits / (len(queries) * k), 4),
+        "k": k,
+        "query_set": "perturbed_midpoints",
+        "queries": len(queries),
+        "flat_ms_per_query": round(flat_ms, 4),
+        "ann_ms_per_query": round(ann_ms, 4),
+    }
+
+
+def _cache_stem(cache_dir: str, kind: str, fingerprint: str) -> str:
+    return os.path.join(cache_dir, f"{ANN_PREFIX}{kind}_v{ANN_CACHE_VERSION}_{fingerprint[:16]}")
+
+
+def prune_ann_cache(cache_dir: str, keep: int = ANN_CACHE_MAX):
+    """LRU sui file ann_*: l'mtime viene aggiornato ad ogni riuso dell'indice."""
+    if not os.path.isdir(cache_dir): return
+    indexes = [f for f in os.listdir(cache_dir) if f.startswith(ANN_PREFIX) and f.endswith(".faiss")]
+    indexes.sort(key=lambda f: os.path.getmtime(os.path.join(cache_dir, f)), reverse=True)
+    for name in indexes[keep:]:
+        drop_ann_cache(cache_dir, stems=[name[:-len(".faiss")]])
+
+
+def drop_ann_cache(cache_dir: str, fingerprints=None, stems=None):
+    """Elimina gli indici ANN dei contesti con questi fingerprint (tutti se None)."""
+    if not os.path.isdir(cache_dir): return
+    suffixes = None if fingerprints is None else {f"_{fp[:16]}" for fp in fingerprints if fp}
+    for name in os.listdir(cache_dir):
+        if not name.startswith(ANN_PREFIX): continue
+        stem = os.path.splitext(name)[0]
+        if stems is not None and stem not in stems: continue
+        if suffixes is not None and not any(stem.endswith(s) for s in suffixes): continue
+        try: os.remove(os.path.join(cache_dir, name))
+        except OSError: pass
+
+
+def optimize_index(db, cache_dir: Optional[str] = None, fingerprint: Optional[str] = None) -> dict:
+    """
+    Sostituisce l'indice flat del contesto (merge degli shard) con quello scelto.
+    Le posizioni non cambiano, quindi index_to_docstore_id resta valido.
+    Con cache_dir + fingerprint l'indice costruito viene riusato ai riavvii: il
+    fingerprint ignora l'ordine dei file, quindi il merge degli shard deve averne
+    uno canonico (merge_shards li ordina per chiave).
+    """
+    import faiss
+    n = db.index.ntotal
+    kind = choose_index_type(n)
+    report = {"type": kind, "chunks": n}
+    if kind == "flat" or n == 0: return report
+
+    cache_path = _cache_stem(cache_dir, kind, fingerprint) if cache_dir and fingerprint else None
+    if cache_path and os.path.exists(cache_path + ".faiss"):
+        try:
+            with open(cache_path + ".json", encoding="utf-8") as f:
+                cached = json.load(f)
+            db.index = faiss.read_index(cache_path + ".faiss")
+            os.utime(cache_path + ".faiss")
+            return {**cached, "cached": True}
+        except Exception as e:
+            print(f"   ⚠️ ANN cache unreadable, rebuilding: {e}")
+
+    t0 = time.time()
+    vectors = db.index.reconstruct_n(0, n)
+    index = build_index(vectors, kind)
+    report["build_s"] = round(time.time() - t0, 2)
+    report.update(recall_report(vectors, index))
+    report["index_mb"] = round(faiss.serialize_index(index).nbytes / (1024 ** 2), 2)
+    report["flat_mb"] = round(vectors.nbytes / (1024 ** 2), 2)
+    db.index = index
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            faiss.write_index(index, cache_path + ".faiss")
+            with open(cache_path + ".json", "w", encoding="utf-8") as f:
+                json.dump(report, f)
+            prune_ann_cache(cache_dir)
+        except Exception as e:
+            print(f"   ⚠️ Could not cache ANN index: {e}")
+    print(f"   🧭 ANN index: {report}")
+    return report
@@ -0,0 +1,79 @@
+import re
+import time
+from collections import Counter
+from typing import Dict, List
+
+import numpy as np
+
+# Parole composte (AES-GCM, SHA-256, x.509) restano intere, piu' le loro parti;
+# gli operatori di confronto (>=, <=, !=) sono token a se' per le formule
+TOKEN_RE = re.compile(r"\w+(?:[-./+:]\w+)*|[<>!=≤≥≠]=?")
+PART_RE = re.compile(r"[-./+:]")
+
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for tok in TOKEN_RE.findall(text.lower()):
+        tokens.append(tok)
+        if PART_RE.search(tok):
+            tokens.extend(p for p in PART_RE.split(tok) if p)
+    return tokens
+
+
+def term_counts(text: str) -> Dict[str, int]:
+    return dict(Counter(tokenize(text)))
+
+
+class BM25Index:
+    """
+    Indice sparso BM25 sui chunk del contesto. Il doc id e' la posizione del chunk
+    nell'indice FAISS, cosi' i risultati si mappano sullo stesso docstore.
+    I pesi BM25 sono precalcolati per ogni posting: una query e' solo una somma.
+    """
+
+    def __init__(self, doc_terms: List[Dict[str, int]]):
+        start = time.time()
+        self.size = len(doc_terms)
+        lengths = np.array([sum(d.values()) for d in doc_terms], dtype=np.float32)
+        avgdl = float(lengths.mean()) if self.size and lengths.sum() > 0 else 1.0
+
+        postings = {}
+        for doc_id, terms in enumerate(doc_terms):
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        self._postings = {}
+        for term, entries in postings.items():
+            ids = np.fromiter((e[0] for e in entries), dtype=np.int32, count=len(entries))
+            tf = np.fromiter((e[1] for e in entries), dtype=np.float32, count=len(entries))
+            idf = np.log(1 + (self.size - len(entries) + 0.5) / (len(entries) + 0.5))
+            norm = K1 * (1 - B + B * lengths[ids] / avgdl)
+            self._postings[term] = (ids, (idf * tf * (K1 + 1) / (tf + norm)).astype(np.float32))
+        self.build_time = time.time() - start
+
+    def search(self, query: str, k: int) -> List[int]:
+        """Doc id dei k chunk con punteggio piu' alto (solo quelli con almeno un termine in comune)."""
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            hit = self._postings.get(term)
+            if hit is not None: scores[hit[0]] += hit[1]
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k)[:k]]
+        return matched[np.argsort(-scores[matched], kind="stable")].tolist()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(ids.nbytes + w.nbytes for ids, w in self._postings.values())
+
+    def stats(self) -> dict:
+        return {
+            "chunks": self.size,
+            "terms": len(self._postings),
+            "postings_mb": round(self.nbytes / (1024 ** 2), 2),
+            "build_s": round(self.build_time, 3),
+        }
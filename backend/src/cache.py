@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+
+def make_key(*parts) -> str:
+    """Chiave stabile a partire da valori serializzabili in JSON."""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    Cache JSON persistente: un file per chiave in `directory`.
+    L'mtime del file fa da timestamp LRU (aggiornato ad ogni hit);
+    oltre `max_entries` vengono eliminati i file meno usati di recente.
+    Con `ttl` (secondi) le voci scadono a partire dalla creazione.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 64, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        if not os.path.exists(path): return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if self.ttl is not None and time.time() - entry.get("created", 0) > self.ttl:
+                os.remove(path)
+                return None
+            return entry
+        except Exception:
+            return None
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._read(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            try: os.utime(self._path(key), None)
+            except OSError: pass
+            return entry.get("value")
+
+    def set(self, key: str, value: Any, meta: Optional[dict] = None):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"value": value, "meta": meta or {}, "created": time.time()}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+            self._evict()
+
+    def delete(self, key: str):
+        with self._lock:
+            path = self._path(key)
+            if os.path.exists(path): os.remove(path)
+
+    def iter_meta(self):
+        """(chiave, meta) di tutte le voci valide: usato per ricostruire indici in RAM."""
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json")]
+        except FileNotFoundError:
+            return
+        for name in names:
+            key = name[:-len(".json")]
+            with self._lock:
+                entry = self._read(key)
+            if entry is not None:
+                yield key, entry.get("meta", {})
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+    def _evict(self):
+        try:
+            entries = [os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith(".json")]
+        except FileNotFoundError:
+            return
+        if len(entries) <= self.max_entries: return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try: os.remove(path)
+            except OSError: pass
+
+
+class ResponseCache(DiskCache):
+    """
+    DiskCache per le risposte dell'LLM con lookup opzionale per similarita':
+    se la chiave esatta manca, cerca tra le voci dello stesso `scope` quella con
+    il testo piu' simile (coseno sugli embedding) sopra `threshold`.
+    """
+
+    def __init__(self, directory: str, max_entries: int, ttl: Optional[float] = None,
+                 embed_fn: Optional[Callable[[str], list]] = None, threshold: float = 0.95):
+        super().__init__(directory, max_entries, ttl)
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.semantic_hits = 0
+        self._scopes = None  # scope -> {key: vettore normalizzato}
+        self._scope_lock = threading.Lock()
+
+    def _embed(self, text: str) -> np.ndarray:
+        vec = np.asarray(self.embed_fn(text), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _load_scopes(self):
+        if self._scopes is not None: return
+        scopes = {}
+        for key, meta in self.iter_meta():
+            if meta.get("scope") and meta.get("vector"):
+                scopes.setdefault(meta["scope"], {})[key] = np.asarray(meta["vector"], dtype=np.float32)
+        self._scopes = scopes
+
+    def lookup(self, key: str, scope: Optional[str] = None, text: Optional[str] = None) -> Optional[Any]:
+        value = self.get(key)
+        if value is not None or self.embed_fn is None or scope is None or text is None:
+            return value
+
+        with self._scope_lock:
+            self._load_scopes()
+            candidates = self._scopes.get(scope)
+            if not candidates: return None
+            keys = list(candidates.keys())
+            matrix = np.stack([candidates[k] for k in keys])
+
+        sims = matrix @ self._embed(text)
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold: return None
+
+        value = self.get(keys[best])
+        if value is None:
+            # Voce scaduta o eliminata dall'LRU (la miss e' gia' stata contata)
+            self.misses -= 1
+            with self._scope_lock: candidates.pop(keys[best], None)
+            return None
+        # La miss sulla chiave esatta diventa un hit semantico
+        self.misses -= 1
+        self.semantic_hits += 1
+        return value
+
+    def store(self, key: str, value: Any, scope: Optional[str] = None, text: Optional[str] = None):
+        meta = {}
+        if self.embed_fn is not None and scope is not None and text is not None:
+            vec = self._embed(text)
+            meta = {"scope": scope, "vector": vec.tolist()}
+            with self._scope_lock:
+                if self._scopes is not None:
+                    self._scopes.setdefault(scope, {})[key] = vec
+        self.set(key, value, meta)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
@@ -0,0 +1,121 @@
+import os
+import json
+import mmap
+from typing import Iterable, List
+
+import numpy as np
+from langchain_core.documents import Document
+
+# File di uno shard: testo dei chunk concatenato (UTF-8), tabella (offset, lunghezza, sorgente, pagina)
+# e l'elenco dei nomi sorgente. Sostituiscono index.pkl (docstore pickled di FAISS.save_local).
+TEXT_FILE = "chunks.txt"
+TABLE_FILE = "chunks.npy"
+SOURCES_FILE = "chunks.json"
+
+TABLE_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("source", "<u2"), ("page", "<i4")])
+
+
+def has_chunk_store(directory: str) -> bool:
+    return os.path.exists(os.path.join(directory, TABLE_FILE))
+
+
+def write_chunk_store(directory: str, docs: Iterable[Document]):
+    """Scrive i chunk nell'ordine delle posizioni FAISS: la posizione e' l'id del chunk."""
+    sources, source_ids, rows = [], {}, []
+    offset = 0
+    with open(os.path.join(directory, TEXT_FILE), "wb") as f:
+        for d in docs:
+            data = d.page_content.encode("utf-8")
+            f.write(data)
+            source = str(d.metadata.get("source", "Unknown"))
+            if source not in source_ids:
+                source_ids[source] = len(sources)
+                sources.append(source)
+            page = d.metadata.get("page")
+            rows.append((offset, len(data), source_ids[source], page if isinstance(page, int) else -1))
+            offset += len(data)
+    np.save(os.path.join(directory, TABLE_FILE), np.array(rows, dtype=TABLE_DTYPE))
+    with open(os.path.join(directory, SOURCES_FILE), "w", encoding="utf-8") as f:
+        json.dump({"sources": sources}, f, ensure_ascii=False)
+
+
+class ChunkStore:
+    """
+    Chunk di uno shard letti su richiesta: tabella e testo sono memory-mapped,
+    quindi caricare il contesto non legge i testi e il sistema operativo
+    porta in RAM solo le pagine dei chunk effettivamente recuperati.
+    """
+
+    def __init__(self, directory: str):
+        self.table = np.load(os.path.join(directory, TABLE_FILE), mmap_mode="r")
+        with open(os.path.join(directory, SOURCES_FILE), encoding="utf-8") as f:
+            self.sources = json.load(f)["sources"]
+        with open(os.path.join(directory, TEXT_FILE), "rb") as f:
+            # mmap di un file vuoto non e' permesso (shard senza testo)
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def __len__(self):
+        return len(self.table)
+
+    def text(self, i: int) -> str:
+        offset, length = int(self.table["offset"][i]), int(self.table["length"][i])
+        return self._blob[offset:offset + length].decode("utf-8")
+
+    def close(self):
+        """
+        Rilascia le mappe dei file: su Windows un file mappato non si puo' cancellare.
+        La tabella (np.memmap) si libera togliendo l'ultimo riferimento.
+        """
+        self.table = np.empty(0, dtype=TABLE_DTYPE)
+        if isinstance(self._blob, mmap.mmap): self._blob.close()
+        self._blob = b""
+
+    def get(self, i: int) -> Document:
+        row = self.table[i]
+        metadata = {"source": self.sources[int(row["source"])]}
+        if row["page"] >= 0: metadata["page"] = int(row["page"])
+        return Document(page_content=self.text(i), metadata=metadata)
+
+
+class ChunkDocstore:
+    """
+    Docstore di FAISS sopra gli shard di un contesto: l'id di un chunk e' la sua
+    posizione nell'indice unito, risolta nello shard giusto con una ricerca binaria.
+    """
+
+    def __init__(self, stores: List[ChunkStore]):
+        self.stores = stores
+        self._starts = np.cumsum([0] + [len(s) for s in stores])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def search(self, doc_id) -> Document:
+        i = int(doc_id)
+        shard = int(np.searchsorted(self._starts, i, side="right")) - 1
+        return self.stores[shard].get(i - int(self._starts[shard]))
+
+    def close(self):
+        for store in self.stores: store.close()
+
+    @property
+    def nbytes(self) -> int:
+        # Solo le strutture sempre residenti: il testo sta nella page cache del sistema operativo
+        return sum(s.table.nbytes + sum(len(x) for x in s.sources) for s in self.stores)
+
+
+class PositionIds:
+    """index_to_docstore_id di FAISS senza dizionario: posizione -> id e' l'identita'."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size: raise KeyError(i)
+        return int(i)
+
+    def __iter__(self):
+        return iter(range(self.size))
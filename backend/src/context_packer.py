@@ -0,0 +1,99 @@
+import os
+from typing import Dict, List
+
+from .utils import estimate_tokens
+
+# --- BUDGET DEL PROMPT DEL BUILDER ---
+# Quota di num_ctx usata davvero: la stima dei token e' approssimata
+CONTEXT_SAFETY = float(os.environ.get("QUIZ_CONTEXT_SAFETY", "0.9"))
+# Token riservati all'output per ogni domanda (testo, opzioni, spiegazione)
+QUESTION_OUTPUT_TOKENS = int(os.environ.get("QUIZ_QUESTION_OUTPUT_TOKENS", "200"))
+DRAFT_PROMPT_TOKENS = 300      # template del draft senza contesto
+TOPIC_HEADER_TOKENS = 25       # intestazione del topic + riga del tipo di domanda
+
+
+class PackedBatch:
+    """Topic di un batch del Builder con il contesto gia' deduplicato e misurato."""
+
+    def __init__(self, index: int, start: int):
+        self.index = index
+        self.start = start              # posizione del primo topic nella sequenza (rotazione dei tipi)
+        self.topics: List[str] = []
+        self.sections: List[str] = []
+        self.sources: Dict[str, str] = {}
+        self.context_tokens = 0
+        self.deduped_chunks = 0
+        self.trimmed_chunks = 0
+
+    @property
+    def context(self) -> str:
+        return "".join(self.sections)
+
+
+def max_topics_per_batch(ctx_size: int, refine_overhead: int, limit: int) -> int:
+    """
+    Il refine riceve il draft intero e lo riscrive: draft + output devono stare
+    in num_ctx insieme alle format instructions.
+    """
+    budget = int(ctx_size * CONTEXT_SAFETY) - refine_overhead
+    return max(1, min(limit, budget // (2 * QUESTION_OUTPUT_TOKENS)))
+
+
+def pack_batches(topics: List[str], topic_docs: dict, ctx_size: int, max_topics: int) -> List[PackedBatch]:
+    """
+    Divide la sequenza di topic in batch che stanno nel contesto del modello.
+    Un chunk recuperato da piu' topic dello stesso batch entra nel prompt una volta
+    sola; un batch si chiude quando il prossimo topic sforerebbe il budget.
+    """
+    budget = int(ctx_size * CONTEXT_SAFETY) - DRAFT_PROMPT_TOKENS
+    batches = []
+    batch, seen = None, {}
+
+    for pos, topic in enumerate(topics):
+        docs = topic_docs.get(topic) or []
+        fixed = TOPIC_HEADER_TOKENS + QUESTION_OUTPUT_TOKENS
+
+        new_docs, shared = [], []
+        if batch is not None:
+            for d in docs:
+                owner = seen.get(d.page_content)
+                if owner is None: new_docs.append(d)
+                elif owner not in shared: shared.append(owner)
+        else:
+            new_docs = list(docs)
+        cost = fixed + sum(estimate_tokens(d.page_content) for d in new_docs)
+
+        used = batch.context_tokens + len(batch.topics) * fixed if batch is not None else 0
+        if batch is None or len(batch.topics) >= max_topics or used + cost > budget:
+            batch = PackedBatch(len(batches), pos)
+            batches.append(batch)
+            seen = {}
+            new_docs, shared = list(docs), []
+
+        topic_no = len(batch.topics) + 1
+        room = budget - batch.context_tokens - len(batch.topics) * fixed - fixed
+        parts = []
+        for d in new_docs:
+            tokens = estimate_tokens(d.page_content)
+            if tokens > room:
+                # Topic da solo oltre il budget: si tronca l'ultimo chunk che entra
+                if room > 50:
+                    parts.append(d.page_content[:room * 4])
+                    batch.context_tokens += room
+                batch.trimmed_chunks += 1
+                room = 0
+                continue
+            parts.append(d.page_content)
+            batch.context_tokens += tokens
+            room -= tokens
+            seen.setdefault(d.page_content, topic_no)
+
+        batch.deduped_chunks += len(docs) - len(new_docs)
+        section = f"\n--- TOPIC {topic_no}: {topic} ---\nSOURCE MATERIAL:\n" + "\n".join(parts) + "\n"
+        if shared:
+            section += "(See also the source material of " + ", ".join(f"TOPIC {n}" for n in shared) + ")\n"
+        batch.topics.append(topic)
+        batch.sections.append(section)
+        if docs: batch.sources[topic] = docs[0].metadata.get('source', 'Unknown')
+
+    return batches
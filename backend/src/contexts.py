@@ -0,0 +1,300 @@
+import os
+import gc
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# --- CONFIGURAZIONE ---
+# RAM per i contesti residenti (indice FAISS + testo dei chunk + BM25), 0 = nessun limite
+CONTEXT_RAM_MB = float(os.environ.get("QUIZ_CONTEXT_RAM_MB", "1024"))
+# Contesti ricordati nel catalogo su disco (ricaricabili dagli shard anche dopo l'eviction)
+MAX_KNOWN_CONTEXTS = int(os.environ.get("QUIZ_MAX_KNOWN_CONTEXTS", "50"))
+
+
+def context_fingerprint(shard_keys) -> str:
+    """Identifica il contenuto di un contesto: stesso insieme di shard = stesso contesto."""
+    return hashlib.sha256("|".join(sorted(set(shard_keys))).encode()).hexdigest()
+
+
+def context_id_for(shard_keys) -> str:
+    return context_fingerprint(shard_keys)[:16]
+
+
+class LoadedContext:
+    """Un contesto residente in RAM: indice FAISS + BM25 del merge degli shard dei suoi file."""
+
+    def __init__(self, context_id: str, shards: Dict[str, str], db, sparse=None,
+                 index_report: Optional[dict] = None, size_bytes: int = 0):
+        self.id = context_id
+        self.shards = dict(shards)           # nome file -> chiave dello shard
+        self.db = db
+        self.sparse = sparse
+        self.index_report = index_report
+        self.size_bytes = size_bytes
+        self.fingerprint = context_fingerprint(shards.values()) if shards else None
+        self.pins = 0
+        self.last_used = time.time()
+
+    @property
+    def files(self) -> List[str]:
+        return list(self.shards.keys())
+
+    def close(self):
+        """Chiude i file memory-mapped dei chunk (prima di cancellare gli shard)."""
+        close = getattr(getattr(self.db, "docstore", None), "close", None)
+        if close is not None: close()
+
+    def to_dict(self) -> dict:
+        return {
+            "context_id": self.id,
+            "files": self.files,
+            "chunks": self.db.index.ntotal if self.db is not None else 0,
+            "size_mb": round(self.size_bytes / (1024 ** 2), 2),
+            "pins": self.pins,
+            "last_used": self.last_used,
+            "index": self.index_report,
+        }
+
+
+class ContextRegistry:
+    """
+    Contesti con id, residenti insieme entro un budget di RAM con eviction LRU.
+    Un contesto in uso (pinned da un job o da una chat in streaming) non viene mai scaricato;
+    uno scaricato resta nel catalogo su disco e si ricarica dagli shard alla richiesta successiva.
+    Il contesto "di default" e' l'ultimo caricato: lo usano le richieste senza context_id.
+    """
+
+    def __init__(self, catalog_path: str, loader: Callable[[str, Dict[str, str]], Optional[LoadedContext]],
+                 budget_mb: float = CONTEXT_RAM_MB, fallback: Optional[Callable[[], Optional[LoadedContext]]] = None):
+        self.catalog_path = catalog_path
+        self.loader = loader
+        self.fallback = fallback
+        self.budget_bytes = int(budget_mb * 1024 ** 2)
+        self.evictions = 0
+        self._resident: "OrderedDict[str, LoadedContext]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._fallback_tried = False
+        catalog = self._read_catalog()
+        self.default_id: Optional[str] = catalog.get("default")
+        self._known: Dict[str, dict] = catalog.get("contexts", {})
+        # Dopo il primo contesto costruito dagli shard l'indice legacy non si usa piu' (i file restano)
+        self.fallback_retired: bool = catalog.get("legacy_retired", False)
+
+    # --- CATALOGO SU DISCO ---
+
+    def _read_catalog(self) -> dict:
+        try:
+            with open(self.catalog_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if "contexts" in data: return data
+        # Formato precedente: un solo contesto {"files": [...], "shards": {file: key}}
+        shards = data.get("shards") or {}
+        if not shards: return {}
+        context_id = context_id_for(shards.values())
+        return {"default": context_id, "contexts": {context_id: {"shards": shards, "last_used": time.time()}}}
+
+    def _save_catalog(self):
+        if len(self._known) > MAX_KNOWN_CONTEXTS:
+            oldest = sorted(self._known, key=lambda c: self._known[c].get("last_used", 0))
+            for context_id in oldest[:len(self._known) - MAX_KNOWN_CONTEXTS]:
+                if context_id != self.default_id and context_id not in self._resident:
+                    self._known.pop(context_id)
+        try:
+            os.makedirs(os.path.dirname(self.catalog_path) or ".", exist_ok=True)
+            tmp = self.catalog_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"default": self.default_id, "contexts": self._known,
+                           "legacy_retired": self.fallback_retired}, f)
+            os.replace(tmp, self.catalog_path)
+        except OSError as e:
+            print(f"   ⚠️ Could not save context catalog: {e}")
+
+    # --- ACCESSO ---
+
+    def _resolve(self, context_id: Optional[str]) -> Optional[str]:
+        return context_id or self.default_id
+
+    def exists(self, context_id: Optional[str]) -> bool:
+        context_id = self._resolve(context_id)
+        return context_id is not None and (context_id in self._resident or context_id in self._known)
+
+    def files(self, context_id: Optional[str] = None) -> List[str]:
+        """File del contesto, senza caricarlo."""
+        context_id = self._resolve(context_id)
+        ctx = self._resident.get(context_id)
+        if ctx is not None: return ctx.files
+        return list(self._known.get(context_id, {}).get("shards", {}).keys())
+
+    def fingerprint(self, context_id: Optional[str] = None) -> Optional[str]:
+        """Fingerprint del contenuto (per le chiavi di cache), senza caricare il contesto."""
+        context_id = self._resolve(context_id)
+        ctx = self._resident.get(context_id)
+        if ctx is not None: return ctx.fingerprint
+        shards = self._known.get(context_id, {}).get("shards")
+        return context_fingerprint(shards.values()) if shards else None
+
+    def peek(self, context_id: Optional[str] = None) -> Optional[LoadedContext]:
+        """Contesto solo se gia' residente (non aggiorna l'LRU, non carica)."""
+        return self._resident.get(self._resolve(context_id))
+
+    def get(self, context_id: Optional[str] = None) -> Optional[LoadedContext]:
+        """Contesto residente (caricato dagli shard se era stato scaricato); None se sconosciuto."""
+        context_id = self._resolve(context_id)
+        if context_id is None: return self._load_fallback()
+        with self._lock:
+            ctx = self._resident.get(context_id)
+            if ctx is not None:
+                self._touch(ctx)
+                return ctx
+            entry = self._known.get(context_id)
+        if entry is None: return None
+
+        # Un solo caricamento alla volta: due richieste sullo stesso contesto non lo costruiscono due volte
+        with self._load_lock:
+            ctx = self._resident.get(context_id)
+            if ctx is None:
+                print(f"📂 [CONTEXT] Reloading {context_id} from shards...")
+                ctx = self.loader(context_id, entry.get("shards", {}))
+                if ctx is None: return None
+                self.add(ctx, make_default=False)
+            else:
+                self._touch(ctx)
+            return ctx
+
+    def _load_fallback(self) -> Optional[LoadedContext]:
+        # Nessun contesto nel catalogo: indice salvato nel formato precedente (una volta sola)
+        if self.fallback is None or self._fallback_tried or self.fallback_retired: return None
+        with self._load_lock:
+            if self._fallback_tried: return self.peek()
+            self._fallback_tried = True
+            ctx = self.fallback()
+        if ctx is not None:
+            with self._lock:
+                self._resident[ctx.id] = ctx
+                self.default_id = ctx.id
+                self._evict(keep=ctx.id)
+        return ctx
+
+    def _touch(self, ctx: LoadedContext):
+        ctx.last_used = time.time()
+        if ctx.id in self._resident: self._resident.move_to_end(ctx.id)
+        entry = self._known.get(ctx.id)
+        if entry is not None: entry["last_used"] = ctx.last_used
+
+    def touch(self, context_id: Optional[str]):
+        """Segna il contesto come usato (es. grading di un quiz): scende in fondo alla coda di eviction."""
+        with self._lock:
+            ctx = self._resident.get(self._resolve(context_id))
+            if ctx is not None: self._touch(ctx)
+
+    def add(self, ctx: LoadedContext, make_default: bool = True):
+        with self._lock:
+            self._resident[ctx.id] = ctx
+            self._touch(ctx)
+            self._known[ctx.id] = {"shards": ctx.shards, "last_used": ctx.last_used}
+            if make_default: self.default_id = ctx.id
+            self._save_catalog()
+            self._evict(keep=ctx.id)
+
+    def retire_fallback(self):
+        with self._lock:
+            if self.fallback_retired: return
+            self.fallback_retired = True
+            self._resident.pop("legacy", None)
+            self._save_catalog()
+
+    # --- PIN (un job tiene il suo contesto fino alla fine) ---
+
+    def acquire(self, context_id: Optional[str] = None) -> Optional[LoadedContext]:
+        # Il caricamento avviene fuori dal lock: le altre richieste non restano bloccate
+        ctx = self.get(context_id)
+        if ctx is None: return None
+        with self._lock:
+            ctx.pins += 1
+        return ctx
+
+    def release(self, ctx: Optional[LoadedContext]):
+        if ctx is None: return
+        with self._lock:
+            ctx.pins = max(0, ctx.pins - 1)
+            # Con tutti i contesti pinned il budget puo' essere stato superato: si recupera ora
+            if ctx.pins == 0: self._evict()
+
+    @contextmanager
+    def use(self, context_id: Optional[str] = None):
+        ctx = self.acquire(context_id)
+        try:
+            yield ctx
+        finally:
+            self.release(ctx)
+
+    # --- EVICTION ---
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(c.size_bytes for c in self._resident.values())
+
+    def _evict(self, keep: Optional[str] = None):
+        if self.budget_bytes <= 0: return
+        freed = False
+        # Dal meno usato di recente: si salta chi e' pinned e il contesto appena caricato
+        for context_id in list(self._resident):
+            if self.resident_bytes <= self.budget_bytes: break
+            ctx = self._resident[context_id]
+            if ctx.pins > 0 or context_id == keep: continue
+            self._resident.pop(context_id)
+            self.evictions += 1
+            freed = True
+            print(f"   🗑️ [CONTEXT] Evicted {context_id} ({ctx.size_bytes / 1024 ** 2:.1f} MB, LRU)")
+        if freed: gc.collect()
+        if self.resident_bytes > self.budget_bytes:
+            print(f"   ⚠️ [CONTEXT] {self.resident_bytes / 1024 ** 2:.1f} MB resident, over budget "
+                  f"({self.budget_bytes / 1024 ** 2:.0f} MB): remaining contexts are in use")
+
+    def drop(self, context_id: str):
+        with self._lock:
+            ctx = self._resident.pop(context_id, None)
+            if ctx is not None: ctx.close()
+            self._known.pop(context_id, None)
+            if self.default_id == context_id: self.default_id = None
+            self._save_catalog()
+
+    def drop_shard(self, shard_key: str) -> List[str]:
+        """
+        Il file di uno shard e' stato cancellato: spariscono i contesti che lo contengono.
+        Ritorna i loro fingerprint (per eliminare gli indici ANN in cache).
+        """
+        with self._lock:
+            ids = [c for c, e in self._known.items() if shard_key in e.get("shards", {}).values()]
+            ids += [c for c, ctx in self._resident.items() if shard_key in ctx.shards.values() and c not in ids]
+            fingerprints = [self.fingerprint(c) for c in ids]
+            for context_id in ids: self.drop(context_id)
+            return [fp for fp in fingerprints if fp]
+
+    def clear(self):
+        with self._lock:
+            for ctx in self._resident.values(): ctx.close()
+            self._resident.clear()
+            self._known.clear()
+            self.default_id = None
+            self._save_catalog()
+        gc.collect()
+
+    def stats(self) -> dict:
+        with self._lock:
+            resident = [c.to_dict() for c in reversed(self._resident.values())]
+            return {
+                "default": self.default_id,
+                "budget_mb": round(self.budget_bytes / (1024 ** 2), 1),
+                "resident_mb": round(self.resident_bytes / (1024 ** 2), 2),
+                "evictions": self.evictions,
+                "known": len(self._known),
+                "resident": resident,
+            }
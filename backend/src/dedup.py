@@ -0,0 +1,85 @@
+import os
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from .utils import normalize_text
+
+# Coseno oltre il quale due domande (o due topic) sono considerate la stessa cosa
+QUESTION_DEDUP_THRESHOLD = float(os.environ.get("QUIZ_DEDUP_THRESHOLD", "0.9"))
+TOPIC_DEDUP_THRESHOLD = float(os.environ.get("QUIZ_TOPIC_DEDUP_THRESHOLD", "0.85"))
+
+
+class EmbeddingDeduper:
+    """
+    Filtro dei quasi-duplicati: gli embedding normalizzati dei testi accettati
+    stanno in un'unica matrice contigua (capacita' raddoppiata quando serve) e
+    ogni nuovo lotto si confronta con tutti in una sola moltiplicazione.
+    Senza embed_fn (o se l'embedding fallisce) resta il confronto esatto sul testo normalizzato.
+    """
+
+    def __init__(self, embed_fn: Optional[Callable[[List[str]], list]], threshold: float):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.rejected = 0
+        self.last_vectors = None   # embedding dei testi accettati dall'ultimo add_unique
+        self._seen = set()
+        self._matrix = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _append(self, vec: np.ndarray):
+        if self._matrix is None:
+            self._matrix = np.empty((16, vec.shape[0]), dtype=np.float32)
+        elif self._count == len(self._matrix):
+            grown = np.empty((len(self._matrix) * 2, self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._count] = self._matrix[:self._count]
+            self._matrix = grown
+        self._matrix[self._count] = vec
+        self._count += 1
+
+    def _embed(self, texts: List[str]) -> Optional[np.ndarray]:
+        if self.embed_fn is None or not texts: return None
+        try:
+            vectors = np.asarray(self.embed_fn(texts), dtype=np.float32)
+        except Exception as e:
+            print(f"   ⚠️ Dedup embedding failed, exact match only: {e}")
+            return None
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def seed(self, texts: List[str]):
+        """Testi gia' coperti (es. topic delle domande della banca): entrano nel filtro senza contare come scarti."""
+        rejected = self.rejected
+        self.add_unique(texts)
+        self.rejected = rejected
+
+    def add_unique(self, texts: List[str], limit: Optional[int] = None, vectors: Optional[np.ndarray] = None) -> List[int]:
+        """Indici dei testi accettati (al massimo `limit`), che entrano nel filtro. `vectors`: embedding gia' normalizzati."""
+        keys = [normalize_text(t) for t in texts]
+        if vectors is None: vectors = self._embed(texts)
+        # Un solo confronto vettoriale del lotto contro tutto lo storico
+        best = None
+        if vectors is not None and self._count:
+            best = (vectors @ self._matrix[:self._count].T).max(axis=1)
+
+        kept = []
+        start = self._count
+        for i, key in enumerate(keys):
+            if limit is not None and len(kept) >= limit: break
+            duplicate = key in self._seen
+            if not duplicate and vectors is not None:
+                duplicate = best is not None and best[i] >= self.threshold
+                # Confronto anche con i testi gia' accettati di questo stesso lotto
+                if not duplicate and self._count > start:
+                    duplicate = float((self._matrix[start:self._count] @ vectors[i]).max()) >= self.threshold
+            if duplicate:
+                self.rejected += 1
+                continue
+            self._seen.add(key)
+            if vectors is not None: self._append(vectors[i])
+            kept.append(i)
+        self.last_vectors = vectors[kept] if vectors is not None else None
+        return kept
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+# Eventi dopo i quali lo stream di un job si chiude
+TERMINAL_EVENTS = ("completed", "failed", "cancelled")
+
+
+class JobEventBus:
+    """
+    Coda di eventi per job (fase, domande validate, fine job) consumata dallo
+    stream SSE. Gli eventi restano in memoria per permettere il replay a chi si
+    collega tardi; si tengono solo gli ultimi `max_jobs` job.
+    """
+
+    def __init__(self, max_jobs: int = 50):
+        self.max_jobs = max_jobs
+        self._events = OrderedDict()
+        self._cond = threading.Condition()
+        self._waiters = {}   # job_id -> {(loop, asyncio.Event)} degli stream SSE in attesa
+
+    def publish(self, job_id: str, event: str, data: dict):
+        with self._cond:
+            events = self._events.get(job_id)
+            if events is None:
+                events = self._events[job_id] = []
+                while len(self._events) > self.max_jobs:
+                    self._events.popitem(last=False)
+            events.append((len(events), event, data))
+            self._cond.notify_all()
+            waiters = list(self._waiters.get(job_id, ()))
+        # publish gira nei thread dei job: gli stream async si svegliano sul loro event loop
+        for loop, ready in waiters:
+            try: loop.call_soon_threadsafe(ready.set)
+            except RuntimeError: pass   # loop gia' chiuso
+
+    def wait_for(self, job_id: str, cursor: int, timeout: float) -> List[Tuple[int, str, dict]]:
+        """Eventi con id >= cursor; attende al massimo `timeout` secondi se non ce ne sono."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._events.get(job_id, ())) > cursor, timeout=timeout)
+            return list(self._events.get(job_id, ())[cursor:])
+
+    async def wait_for_async(self, job_id: str, cursor: int, timeout: float) -> List[Tuple[int, str, dict]]:
+        """Come wait_for, ma attende sull'event loop: uno stream SSE non occupa un thread del pool."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            events = self._events.get(job_id, ())[cursor:]
+            if events: return list(events)
+            self._waiters.setdefault(job_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                waiters = self._waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters: self._waiters.pop(job_id)
+        with self._cond:
+            return list(self._events.get(job_id, ())[cursor:])
@@ -0,0 +1,140 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Tuple, Callable
+
+from .vector_store import CHUNK_SIZE, CHUNK_OVERLAP
+from .metrics import PHASE_SECONDS
+
+# --- CONFIGURAZIONE PIPELINE ---
+# 0 = automatico (core - 1). Il parsing di un PDF e' CPU-bound: va su processi separati.
+INGEST_WORKERS = int(os.environ.get("QUIZ_INGEST_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+# Chunk per chiamata all'embedder: limita la memoria di picco durante l'indicizzazione
+EMBED_BATCH_SIZE = int(os.environ.get("QUIZ_EMBED_BATCH_SIZE", "64"))
+
+
+def parse_and_split(f_name: str, path: str) -> Tuple[int, list, dict]:
+    """Worker (gira in un processo separato): estrae il testo e lo divide in chunk."""
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    t0 = time.perf_counter()
+    docs = PyPDFLoader(path).load()
+    for d in docs: d.metadata['source'] = f_name
+    t1 = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    splits = splitter.split_documents(docs)
+    # I tempi tornano al processo principale, che tiene le metriche
+    timings = {"parse": t1 - t0, "split": time.perf_counter() - t1}
+    return len(docs), [(d.page_content, d.metadata) for d in splits], timings
+
+
+class IngestionStats:
+    def __init__(self):
+        self.files = 0
+        self.pages = 0
+        self.chunks = 0
+        self.failed = []
+        self.errors = {}          # nome file -> motivo del fallimento
+        self.embed_time = 0.0
+        self.start = time.time()
+        self.total_time = 0.0
+
+    def to_dict(self) -> dict:
+        total = self.total_time or (time.time() - self.start)
+        return {
+            "files": self.files,
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "failed": self.failed,
+            "errors": self.errors,
+            "embed_s": round(self.embed_time, 2),
+            "total_s": round(total, 2),
+            "pages_per_s": round(self.pages / total, 1) if total > 0 else 0.0,
+            "chunks_per_s": round(self.chunks / total, 1) if total > 0 else 0.0,
+        }
+
+
+def _embed_into_shard(chunks: list, embeddings, stats: IngestionStats):
+    """Embedding a batch fissi: i vettori entrano in FAISS appena calcolati."""
+    from langchain_community.vectorstores import FAISS
+
+    shard_db = None
+    for i in range(0, len(chunks), EMBED_BATCH_SIZE):
+        batch = chunks[i:i + EMBED_BATCH_SIZE]
+        texts = [c[0] for c in batch]
+        metadatas = [c[1] for c in batch]
+
+        t0 = time.time()
+        vectors = embeddings.embed_documents(texts)
+        stats.embed_time += time.time() - t0
+        PHASE_SECONDS.observe(time.time() - t0, "embed")
+
+        pairs = list(zip(texts, vectors))
+        if shard_db is None:
+            shard_db = FAISS.from_embeddings(pairs, embeddings, metadatas=metadatas)
+        else:
+            shard_db.add_embeddings(pairs, metadatas=metadatas)
+    return shard_db
+
+
+def ingest_files(files: List[Tuple[str, str, str]], embeddings, on_shard: Callable) -> IngestionStats:
+    """
+    Pipeline di indicizzazione: files = [(nome, path, shard_key)].
+    Il parsing gira su un pool di processi, l'embedding nel processo principale
+    man mano che i file arrivano. on_shard(nome, key, faiss_db) salva lo shard.
+    """
+    stats = IngestionStats()
+    if not files: return stats
+
+    def fail(f_name, reason):
+        stats.failed.append(f_name)
+        stats.errors[f_name] = reason
+
+    def handle(f_name, key, pages, chunks, timings):
+        for phase, seconds in timings.items(): PHASE_SECONDS.observe(seconds, phase)
+        if not chunks:
+            print(f"   ⚠️ No text extracted from {f_name}")
+            fail(f_name, "No text extracted")
+            return
+        shard_db = _embed_into_shard(chunks, embeddings, stats)
+        on_shard(f_name, key, shard_db)
+        stats.files += 1
+        stats.pages += pages
+        stats.chunks += len(chunks)
+        print(f"   🧩 Shard built: {f_name} ({pages} pages, {len(chunks)} chunks)")
+
+    workers = min(INGEST_WORKERS, len(files))
+    if workers <= 1:
+        # Un solo file: avviare un processo costa piu' del parsing stesso
+        for f_name, path, key in files:
+            try:
+                handle(f_name, key, *parse_and_split(f_name, path))
+            except Exception as e:
+                print(f"   ❌ Error loading {f_name}: {e}")
+                fail(f_name, str(e))
+    else:
+        print(f"   ⚙️ Parsing on {workers} processes (embed batch: {EMBED_BATCH_SIZE})")
+        pending = list(files)
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while pending or in_flight:
+                # Finestra limitata: al massimo 2 file per worker in attesa di embedding
+                while pending and len(in_flight) < workers * 2:
+                    f_name, path, key = pending.pop(0)
+                    in_flight[pool.submit(parse_and_split, f_name, path)] = (f_name, key)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    f_name, key = in_flight.pop(fut)
+                    try:
+                        handle(f_name, key, *fut.result())
+                    except Exception as e:
+                        print(f"   ❌ Error loading {f_name}: {e}")
+                        fail(f_name, str(e))
+
+    stats.total_time = time.time() - stats.start
+    s = stats.to_dict()
+    print(f"   📈 Ingestion: {s['pages']} pages, {s['chunks']} chunks in {s['total_s']}s "
+          f"({s['pages_per_s']} pages/s, {s['chunks_per_s']} chunks/s)")
+    return stats
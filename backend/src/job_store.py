@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional
+
+from .utils import DATA_DIR
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+# --- CONFIGURAZIONE ---
+JOB_STORE_BACKEND = os.environ.get("QUIZ_JOB_STORE", "sqlite")  # "sqlite" | "memory"
+JOB_DB_PATH = os.environ.get("QUIZ_JOB_DB") or os.path.join(DATA_DIR, "quiz_jobs.db")
+JOB_TTL_SECONDS = float(os.environ.get("QUIZ_JOB_TTL_HOURS", "168")) * 3600
+JOB_MAX_FINISHED = int(os.environ.get("QUIZ_JOB_MAX_FINISHED", "200"))
+
+
+def _summary(job_id: str, data: dict) -> dict:
+    """Vista leggera di un job per le liste (senza le domande)."""
+    summary = {k: v for k, v in data.items() if k not in ("result", "batch_timings")}
+    summary["job_id"] = job_id
+    summary["result_count"] = len(data.get("result") or [])
+    return summary
+
+
+class JobStore(ABC):
+    """
+    Stato dei job di generazione. Solo i job conclusi (completed/failed/cancelled)
+    sono soggetti a eviction: per eta' (ttl) e per numero (max_finished).
+    update() fa merge dei soli campi passati, in modo atomico.
+    """
+
+    def __init__(self, ttl: float = JOB_TTL_SECONDS, max_finished: int = JOB_MAX_FINISHED):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._lock = threading.RLock()
+
+    @abstractmethod
+    def create(self, job_id: str, data: dict): ...
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    def update(self, job_id: str, **fields): ...
+
+    @abstractmethod
+    def list(self, limit: int = 50) -> List[dict]: ...
+
+    @abstractmethod
+    def evict(self): ...
+
+    def get_status(self, job_id: str) -> Optional[str]:
+        job = self.get(job_id)
+        return job.get("status") if job else None
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.get_status(job_id) is not None
+
+
+class MemoryJobStore(JobStore):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._jobs = OrderedDict()
+
+    def create(self, job_id: str, data: dict):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {**data, "created": now, "updated": now}
+            self.evict()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            if job_id not in self._jobs: return
+            self._jobs[job_id].update(fields, updated=time.time())
+
+    def list(self, limit: int = 50) -> List[dict]:
+        with self._lock:
+            items = list(self._jobs.items())[-limit:]
+        return [_summary(job_id, data) for job_id, data in reversed(items)]
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            finished = [(j, d) for j, d in self._jobs.items() if d.get("status") in FINISHED_STATUSES]
+            expired = [j for j, d in finished if now - d.get("updated", now) > self.ttl]
+            overflow = len(finished) - len(expired) - self.max_finished
+            if overflow > 0:
+                alive = [j for j, _ in finished if j not in expired]
+                expired.extend(alive[:overflow])
+            for job_id in expired:
+                self._jobs.pop(job_id, None)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Job su file SQLite: sopravvivono al riavvio e le domande (colonna result)
+    vengono lette solo quando si chiede il singolo job.
+    """
+
+    def __init__(self, path: str = JOB_DB_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT,
+                    created REAL,
+                    updated REAL,
+                    meta TEXT,
+                    result TEXT
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs(status, updated)")
+            self._conn.commit()
+        self._mark_interrupted()
+        self.evict()
+
+    def _mark_interrupted(self):
+        # I job rimasti a meta' dopo un riavvio non ripartono: si segnano come falliti
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id FROM jobs WHERE status NOT IN ({','.join('?' * len(FINISHED_STATUSES))})",
+                FINISHED_STATUSES).fetchall()
+        for (job_id,) in rows:
+            self.update(job_id, status="failed", error="Interrupted by backend restart")
+
+    def create(self, job_id: str, data: dict):
+        now = time.time()
+        meta = {k: v for k, v in data.items() if k not in ("result", "status")}
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, created, updated, meta, result) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, data.get("status"), now, now, json.dumps(meta), json.dumps(data.get("result"))))
+            self._conn.commit()
+            self.evict()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT status, created, updated, meta, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None: return None
+        status, created, updated, meta, result = row
+        job = json.loads(meta)
+        job.update(status=status, created=created, updated=updated)
+        result = json.loads(result) if result else None
+        if result is not None: job["result"] = result
+        return job
+
+    def get_status(self, job_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            row = self._conn.execute("SELECT status, meta FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None: return
+            status, meta = row
+            meta = json.loads(meta)
+            result = fields.pop("result", None)
+            status = fields.pop("status", status)
+            meta.update(fields)
+            if result is not None:
+                self._conn.execute("UPDATE jobs SET status = ?, updated = ?, meta = ?, result = ? WHERE id = ?",
+                                   (status, time.time(), json.dumps(meta), json.dumps(result), job_id))
+            else:
+                self._conn.execute("UPDATE jobs SET status = ?, updated = ?, meta = ? WHERE id = ?",
+                                   (status, time.time(), json.dumps(meta), job_id))
+            self._conn.commit()
+
+    def list(self, limit: int = 50) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, status, created, updated, meta, json_array_length(result) FROM jobs ORDER BY created DESC LIMIT ?",
+                (limit,)).fetchall()
+        jobs = []
+        for job_id, status, created, updated, meta, count in rows:
+            data = json.loads(meta)
+            data.update(status=status, created=created, updated=updated)
+            summary = _summary(job_id, data)
+            summary["result_count"] = count or 0
+            jobs.append(summary)
+        return jobs
+
+    def evict(self):
+        placeholders = ",".join("?" * len(FINISHED_STATUSES))
+        with self._lock:
+            self._conn.execute(f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated < ?",
+                               (*FINISHED_STATUSES, time.time() - self.ttl))
+            self._conn.execute(f"""
+                DELETE FROM jobs WHERE id IN (
+                    SELECT id FROM jobs WHERE status IN ({placeholders})
+                    ORDER BY updated DESC LIMIT -1 OFFSET ?
+                )""", (*FINISHED_STATUSES, self.max_finished))
+            self._conn.commit()
+
+
+def create_job_store() -> JobStore:
+    if JOB_STORE_BACKEND == "memory":
+        return MemoryJobStore()
+    try:
+        return SQLiteJobStore(JOB_DB_PATH)
+    except Exception as e:
+        print(f"   ⚠️ Job DB unavailable ({e}), using in-memory job store.")
+        return MemoryJobStore()
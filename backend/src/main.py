@@ -1,27 +1,52 @@
 import logging
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException
+import json
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import os
 import shutil
 import uuid
+import hashlib
+import psutil
+
+_import_start = time.time()
 
 # Importa AVAILABLE_MODELS per leggere la configurazione reale
 from .ai_engine import engine, LIBRARY_DIR
-from .models import QuizRequest, AVAILABLE_MODELS, ChatRequest, GradeRequest, RegenerateRequest
+from .events import TERMINAL_EVENTS
+from .vector_store import RETRIEVAL_MODE
+from .metrics import registry
+from .models import QuizRequest, AVAILABLE_MODELS, ChatRequest, GradeRequest, GradeBatchRequest, RegenerateRequest
 
 # --- LOGGING FILTER CONFIGURATION ---
 # Questa classe filtra i log di Uvicorn per nascondere le richieste di polling fastidiose
 class EndpointFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
         # Nascondi i log che contengono questo path
-        return record.getMessage().find("/quiz/status/") == -1
+        message = record.getMessage()
+        return "/quiz/status/" not in message and "/system/metrics" not in message
 
 # Applichiamo il filtro al logger di accesso di uvicorn
 logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
-app = FastAPI()
+engine.startup_timings["import"] = round(time.time() - _import_start, 3)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Il server risponde subito (/system/status compreso): i modelli si caricano in background
+    try:
+        engine.startup_timings["process_to_listening"] = round(time.time() - psutil.Process().create_time(), 3)
+    except Exception:
+        pass
+    engine.start_warmup()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,10 +55,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+HTTP_SECONDS = registry.histogram("quiz_http_request_seconds", "HTTP request latency by route", ("method", "route", "status"))
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Path del template (/quiz/status/{job_id}), non quello concreto: label a cardinalita' limitata
+    route = request.scope.get("route")
+    HTTP_SECONDS.observe(time.perf_counter() - start, request.method,
+                         getattr(route, "path", "unmatched"), str(response.status_code))
+    return response
+
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
 # --- MODELLI DI RICHIESTA AGGIUNTIVI ---
 class ContextRequest(BaseModel):
     filenames: List[str]
 
+def _require_context(context_id: Optional[str]):
+    if context_id and not engine.contexts.exists(context_id):
+        raise HTTPException(status_code=404, detail="Context not found. Load it again with /system/load-context")
+
 # --- ENDPOINTS SISTEMA ---
 
 @app.get("/system/status")
@@ -43,6 +86,7 @@ def status():
     da models.py invece che averla hardcoded.
     """
     files = os.listdir(LIBRARY_DIR) if os.path.exists(LIBRARY_DIR) else []
+    pdfs = [f for f in files if f.endswith(".pdf")]
     
     # Costruzione dinamica della lista modelli per il frontend
     model_list = []
@@ -53,61 +97,123 @@ def status():
             "active": (key == engine.current_model_id) # True se è quello in uso
         })
 
+    default_ctx = engine.contexts.peek()
     return {
         "status": "online",
         "model": engine.current_model_id,
-        "files": [f for f in files if f.endswith(".pdf")],
+        "files": pdfs,
+        "indexing": engine.indexing_status(pdfs),
         "active_context": engine.active_files,
-        "models": model_list # Ora invia la lista vera
+        "contexts": engine.contexts.stats(),
+        "models": model_list, # Ora invia la lista vera
+        "caches": engine.cache_stats(),
+        "question_bank": engine.question_bank.stats() if engine.question_bank else None,
+        "retrieval": {"mode": RETRIEVAL_MODE,
+                      "bm25": default_ctx.sparse.stats() if default_ctx and default_ctx.sparse else None,
+                      "index": default_ctx.index_report if default_ctx else None},
+        "ready": engine.readiness(),
+        "last_model_load": engine.last_load,
+        "startup_timings": engine.startup_timings
     }
 
+@app.get("/system/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    """Metriche in formato testo Prometheus (latenze per fase, token, cache, RAM)."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/system/switch-model/{model_id}")
-def switch_model_endpoint(model_id: str):
+def switch_model_endpoint(model_id: str, keep_alive: Optional[str] = None, warm_next: Optional[str] = None):
     """
     Endpoint mancante richiesto dal frontend per cambiare modello.
+    Precarica i pesi in Ollama (keep_alive es. "30m", "-1m" = sempre) e
+    opzionalmente tiene caldo in background anche `warm_next`.
     """
     if model_id not in AVAILABLE_MODELS:
         raise HTTPException(status_code=404, detail="Model ID not found")
+    if warm_next and warm_next not in AVAILABLE_MODELS:
+        raise HTTPException(status_code=404, detail="warm_next model ID not found")
     
-    success = engine.load_llm(model_id)
+    success = engine.load_llm(model_id, keep_alive=keep_alive, preload=True)
     if not success:
         raise HTTPException(status_code=500, detail="Failed to load model in Ollama")
         
-    return {"status": "ok", "current_model": engine.current_model_id}
+    return {
+        "status": "ok",
+        "current_model": engine.current_model_id,
+        "keep_alive": engine.keep_alive,
+        "load": engine.last_load,
+        "warming": engine.warm_model(warm_next, keep_alive)
+    }
 
 @app.post("/system/load-context")
 def load_context_endpoint(req: ContextRequest):
-    count = engine.load_context(req.filenames)
-    return {"status": "ok", "loaded_files": count}
+    ctx = engine.load_context(req.filenames)
+    return {
+        "status": "ok",
+        "context_id": ctx.id if ctx else None,
+        "loaded_files": len(ctx.files) if ctx else 0,
+        "ingest": engine.last_ingest_stats,
+    }
 
 # --- GESTIONE FILE (ARCHIVIO) ---
 
 @app.post("/files/upload")
 async def upload_pdf(file: UploadFile = File(...)):
+    """
+    Salva il PDF calcolandone l'hash mentre arriva: un file identico a uno gia'
+    in libreria (anche con altro nome) viene rifiutato. L'indicizzazione parte
+    subito in background, lo stato e' in /system/status -> "indexing".
+    """
     if not os.path.exists(LIBRARY_DIR): os.makedirs(LIBRARY_DIR)
     
     path = os.path.join(LIBRARY_DIR, file.filename)
     if os.path.exists(path):
         raise HTTPException(status_code=409, detail="File already exists in library")
-        
-    with open(path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    return {"status": "ok", "filename": file.filename}
+
+    tmp_path = path + ".part"
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as buffer:
+            while block := await file.read(UPLOAD_BLOCK_SIZE):
+                digest.update(block)
+                buffer.write(block)
+        key = engine.vector_store.finish_key(digest)
+        # Il primo confronto legge (una volta) gli altri PDF: fuori dall'event loop
+        duplicate = await run_in_threadpool(engine.find_duplicate, key)
+        if duplicate:
+            raise HTTPException(status_code=409, detail=f"Identical file already in library: {duplicate}")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    engine.vector_store.remember_key(path, key)
+    engine.schedule_indexing(file.filename)
+    return {"status": "ok", "filename": file.filename, "indexing": engine.index_status.get(file.filename, {}).get("state")}
 
 @app.delete("/files/delete/{filename}")
 def delete_file(filename: str):
     path = os.path.join(LIBRARY_DIR, filename)
     if os.path.exists(path):
-        os.remove(path)
-        if filename in engine.active_files:
-            engine.active_files = [] 
+        # Rimuove anche lo shard di embedding del file e i contesti che lo contenevano.
+        # I contesti si chiudono prima: su Windows i file mappati dei chunk non si possono cancellare
+        try:
+            key = engine.vector_store.shard_key(path)
+            engine.vector_store.drop_ann(engine.contexts.drop_shard(key))
+            engine.vector_store.drop_shard(key)
+            os.remove(path)
+        except OSError as e:
+            raise HTTPException(status_code=409, detail=f"Could not delete {filename}: {e}")
+        if engine.question_bank: engine.question_bank.drop_shard(key)
+        engine.forget_file(filename)
         return {"status": "deleted"}
     return {"status": "error"}
 
 @app.delete("/files/clear_all")
 def clear_all_files():
     try:
+        # Prima si chiudono i contesti residenti (chunk memory-mapped), poi si cancellano i file
+        engine.contexts.clear() # Reset context
+        failed = []
         if os.path.exists(LIBRARY_DIR):
             for filename in os.listdir(LIBRARY_DIR):
                 file_path = os.path.join(LIBRARY_DIR, filename)
@@ -118,8 +224,14 @@ def clear_all_files():
                         shutil.rmtree(file_path)
                 except Exception as e:
                     print(f'Failed to delete {file_path}. Reason: {e}')
-        engine.active_files = [] # Reset context
+                    failed.append(filename)
+        engine.vector_store.drop_ann()
+        engine.index_status.clear()
+        if engine.question_bank: engine.question_bank.clear()
+        if failed: raise HTTPException(status_code=409, detail=f"Could not delete: {', '.join(failed)}")
         return {"status": "cleared"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -127,14 +239,40 @@ def clear_all_files():
 
 @app.post("/quiz/grade")
 def grade_endpoint(req: GradeRequest):
+    engine.contexts.touch(req.context_id)
     result = engine.grade_answer(req.question, req.correct_answer, req.user_answer, req.language)
     return result
 
+@app.post("/quiz/grade_batch")
+def grade_batch_endpoint(req: GradeBatchRequest):
+    """Valuta piu' risposte aperte in una richiesta: un risultato per item, nello stesso ordine."""
+    for context_id in {item.context_id for item in req.items if item.context_id}:
+        engine.contexts.touch(context_id)
+    return {"results": engine.grade_answers_batch(req.items)}
+
 @app.post("/chat")
 def chat_endpoint(req: ChatRequest):
-    answer = engine.get_chat_response(req.question, req.language)
+    _require_context(req.context_id)
+    answer = engine.get_chat_response(req.question, req.language, req.context_id)
     return {"answer": answer}
 
+@app.post("/chat/stream")
+def chat_stream_endpoint(req: ChatRequest):
+    """
+    Variante in streaming di /chat (Server-Sent Events): un evento "token" per
+    ogni frammento generato, poi "done" con first_token_s e total_s.
+    """
+    _require_context(req.context_id)
+    def event_stream():
+        try:
+            for name, data in engine.stream_chat_response(req.question, req.language, req.context_id):
+                payload = {"text": data} if name == "token" else data
+                yield f"event: {name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.post("/quiz/regenerate_single")
 def regen_endpoint(req: RegenerateRequest):
     new_question = engine.regenerate_question(req.question_text, req.instruction, req.language)
@@ -143,18 +281,64 @@ def regen_endpoint(req: RegenerateRequest):
 
 @app.post("/quiz/start_generation")
 def start_gen(req: QuizRequest, background_tasks: BackgroundTasks):
+    _require_context(req.context_id)
     job_id = str(uuid.uuid4())
-    engine.jobs[job_id] = {"status": "pending", "progress": 0, "total": req.num_questions}
+    engine.jobs.create(job_id, {"status": "pending", "progress": 0, "total": req.num_questions, "request": req.model_dump()})
     background_tasks.add_task(engine.generate_quiz_task, job_id, req)
     return {"job_id": job_id}
 
 @app.get("/quiz/status/{job_id}")
 def get_status(job_id: str):
-    return engine.jobs.get(job_id, {"status": "not_found"})
+    return engine.jobs.get(job_id) or {"status": "not_found"}
+
+@app.get("/quiz/jobs")
+def list_jobs(limit: int = 50):
+    """Job recenti (senza le domande): per riaprire un quiz generato in passato."""
+    return {"jobs": engine.jobs.list(limit)}
+
+@app.get("/quiz/jobs/{job_id}")
+def get_job(job_id: str):
+    job = engine.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"job_id": job_id, **job}
+
+@app.get("/quiz/stream/{job_id}")
+async def stream_job(job_id: str, request: Request):
+    """
+    Server-Sent Events del job: "phase", "questions" (domande validate di ogni
+    batch, appena pronte), poi "completed" / "failed" / "cancelled".
+    Supporta la riconnessione tramite l'header Last-Event-ID.
+    """
+    if not await run_in_threadpool(engine.jobs.__contains__, job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    last_id = request.headers.get("last-event-id")
+    start = int(last_id) + 1 if last_id and last_id.isdigit() else 0
+
+    # Generatore async: l'attesa degli eventi non tiene occupato un thread del threadpool
+    async def event_stream():
+        cursor = start
+        while True:
+            events = await engine.events.wait_for_async(job_id, cursor, timeout=15)
+            if not events:
+                status = await run_in_threadpool(engine.jobs.get_status, job_id)
+                if status is None: return
+                if status in TERMINAL_EVENTS:
+                    # Eventi gia' scartati dal bus (job vecchio): basta lo stato finale
+                    yield f"event: {status}\ndata: {{}}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for seq, name, data in events:
+                cursor = seq + 1
+                yield f"id: {seq}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                if name in TERMINAL_EVENTS: return
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.post("/quiz/stop/{job_id}")
 def stop_gen(job_id: str):
-    if job_id in engine.jobs:
-        engine.jobs[job_id]["status"] = "cancelled"
+    if engine.cancel_job(job_id):
         return {"status": "cancelled"}
     raise HTTPException(status_code=404, detail="Job not found")
\ No newline at end of file
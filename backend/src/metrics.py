@@ -0,0 +1,184 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from .utils import estimate_tokens
+
+# Bucket (secondi) adatti sia alle ricerche FAISS (ms) sia alle chiamate LLM (decine di s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, v in items:
+            yield f"{self.name}{_fmt_labels(self.labels, labels)} {_fmt_value(v)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, list] = {}   # labels -> [conteggi per bucket, somma, conteggio]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self._series.items())
+        for labels, (counts, total, count) in items:
+            for bound, c in zip(self.buckets, counts):
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_fmt_labels(self.labels, labels, le)} {c}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_fmt_labels(self.labels, labels, le)} {count}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, labels)} {_fmt_value(round(total, 6))}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, labels)} {count}"
+
+
+class MetricsRegistry:
+    """
+    Contatori e istogrammi in-process, esposti in formato testo Prometheus.
+    I valori calcolati al momento (cache, RAM) arrivano dai collector registrati:
+    funzioni che ritornano [(nome, tipo, help, label_names, {label_values: valore})].
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, fn: Callable[[], list]):
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for fn in self._collectors:
+            try:
+                samples = fn()
+            except Exception as e:
+                print(f"   ⚠️ Metrics collector failed: {e}")
+                continue
+            for name, kind, help_text, label_names, values in samples:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, v in values.items():
+                    lines.append(f"{name}{_fmt_labels(label_names, labels)} {_fmt_value(v)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- METRICHE DEL BACKEND ---
+PHASE_SECONDS = registry.histogram(
+    "quiz_phase_seconds", "Latency of each pipeline phase (parse, split, embed, faiss_search, llm_*, json_parse, ...)", ("phase",))
+LLM_CALLS = registry.counter("quiz_llm_calls_total", "LLM calls by purpose and outcome", ("call", "outcome"))
+LLM_TOKENS = registry.counter("quiz_llm_tokens_total", "LLM tokens by purpose and direction (in = prompt, out = completion)", ("call", "direction"))
+JSON_PARSE = registry.counter("quiz_json_parse_total", "Parsing of LLM JSON output by kind and result", ("kind", "result"))
+
+
+@contextmanager
+def timed(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.observe(time.perf_counter() - start, phase)
+
+
+# Tag passati a chain.invoke(config={"tags": [...]}) che identificano la chiamata
+LLM_CALL_TAGS = ("architect", "draft", "refine", "structured", "chat", "grade", "grade_batch", "regenerate", "salvage")
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """
+    Callback LangChain agganciata al modello: misura ogni chiamata LLM (fase llm_<tag>)
+    e conta i token. Usa usage_metadata di Ollama, altrimenti una stima dal testo.
+    """
+
+    def __init__(self):
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        call = next((t for t in (tags or []) if t in LLM_CALL_TAGS), "other")
+        prompt = "".join(str(m.content) for batch in messages for m in batch)
+        with self._lock:
+            self._runs[run_id] = (time.perf_counter(), call, estimate_tokens(prompt))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None: return
+        start, call, prompt_estimate = run
+        PHASE_SECONDS.observe(time.perf_counter() - start, f"llm_{call}")
+        LLM_CALLS.inc(call, "ok")
+
+        tokens_in, tokens_out = prompt_estimate, 0
+        for generations in response.generations:
+            for gen in generations:
+                usage = getattr(getattr(gen, "message", None), "usage_metadata", None)
+                if usage:
+                    tokens_in, tokens_out = usage.get("input_tokens", tokens_in), tokens_out + usage.get("output_tokens", 0)
+                else:
+                    tokens_out += estimate_tokens(gen.text)
+        LLM_TOKENS.inc(call, "in", amount=tokens_in)
+        LLM_TOKENS.inc(call, "out", amount=tokens_out)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is not None: LLM_CALLS.inc(run[1], "error")
+
+
+llm_metrics = LLMMetricsHandler()
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import List, Optional, Any, Union
 
 # --- CONFIGURAZIONE MODELLI OLLAMA ---
@@ -63,6 +63,9 @@ class AIQuestion(BaseModel):
         return str(v)
 
 class AIQuizOutput(BaseModel):
+    # Accetta sia "domande" (alias dello schema) sia "questions"
+    model_config = ConfigDict(populate_by_name=True)
+
     questions: List[AIQuestion] = Field(description="Lista delle domande.", alias="domande")
 
 # --- SCHEMI REQUEST ---
@@ -71,6 +74,7 @@ class ChatRequest(BaseModel):
     question: str
     model_id: str = "balanced"
     language: str = "en" 
+    context_id: Optional[str] = None # contesto da /system/load-context (default: l'ultimo caricato)
 
 class QuizRequest(BaseModel):
     num_questions: int
@@ -79,12 +83,21 @@ class QuizRequest(BaseModel):
     question_type: str = "mixed" 
     max_options: int = 4
     model_id: str = "balanced"
+    refresh_topics: bool = False # True = ignora la cache dei topic e rigenera il pool
+    concurrency: Optional[int] = None # batch del Builder in parallelo (default: QUIZ_BUILDER_CONCURRENCY)
+    generation_mode: str = "two_step" # "two_step" (draft + refine) | "single_pass" (output JSON strutturato)
+    from_bank: bool = False # True = prima le domande gia' validate della banca, l'LLM genera solo quelle mancanti
+    context_id: Optional[str] = None # contesto da /system/load-context (default: l'ultimo caricato)
 
 class GradeRequest(BaseModel):
     question: str
     correct_answer: str
     user_answer: str
     language: str
+    context_id: Optional[str] = None # contesto del quiz: il grading lo mantiene "recente" nell'LRU
+
+class GradeBatchRequest(BaseModel):
+    items: List[GradeRequest]
 
 class RegenerateRequest(BaseModel):
     question_text: str
@@ -0,0 +1,75 @@
+import os
+import time
+import threading
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Stesso host usato da ChatOllama (variabile standard di Ollama)
+OLLAMA_URL = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+if not OLLAMA_URL.startswith("http"): OLLAMA_URL = "http://" + OLLAMA_URL
+OLLAMA_URL = OLLAMA_URL.rstrip("/")
+
+# Quanto a lungo Ollama tiene il modello in memoria dopo l'ultima richiesta
+DEFAULT_KEEP_ALIVE = os.environ.get("QUIZ_OLLAMA_KEEP_ALIVE", "30m")
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Sessione HTTP condivisa: le connessioni verso Ollama restano aperte e riusate."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+
+def list_models(timeout: float = 3) -> Optional[List[str]]:
+    """Nomi dei modelli installati, None se Ollama non risponde."""
+    try:
+        res = get_session().get(f"{OLLAMA_URL}/api/tags", timeout=timeout)
+        if res.status_code == 200:
+            return [m['name'] for m in res.json().get('models', [])]
+    except requests.RequestException:
+        pass
+    return None
+
+
+def preload(model: str, num_ctx: int, keep_alive: str = DEFAULT_KEEP_ALIVE, timeout: float = 300) -> dict:
+    """
+    Carica i pesi del modello in Ollama con una generate a prompt vuoto.
+    num_ctx deve coincidere con quello di ChatOllama, altrimenti Ollama ricarica il modello.
+    """
+    start = time.time()
+    res = get_session().post(f"{OLLAMA_URL}/api/generate", json={
+        "model": model,
+        "prompt": "",
+        "keep_alive": keep_alive,
+        "options": {"num_ctx": num_ctx},
+    }, timeout=timeout)
+    res.raise_for_status()
+    data = res.json()
+    return {
+        "model": model,
+        "keep_alive": keep_alive,
+        "load_s": round(time.time() - start, 3),
+        "ollama_load_s": round(data.get("load_duration", 0) / 1e9, 3),
+    }
+
+
+def preload_async(model: str, num_ctx: int, keep_alive: str = DEFAULT_KEEP_ALIVE):
+    def run():
+        try:
+            info = preload(model, num_ctx, keep_alive)
+            print(f"   🔥 Kept warm: {model} ({info['load_s']}s)")
+        except Exception as e:
+            print(f"   ⚠️ Warm-up of {model} failed: {e}")
+    threading.Thread(target=run, name=f"ollama-warm-{model}", daemon=True).start()
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .utils import normalize_text, DATA_DIR
+from .cache import make_key
+
+# --- CONFIGURAZIONE ---
+BANK_DB_PATH = os.environ.get("QUIZ_QUESTION_BANK_DB") or os.path.join(DATA_DIR, "question_bank.db")
+# Selezione MMR: peso della rilevanza rispetto alla diversita' (1 = solo rilevanza, 0 = solo diversita')
+BANK_MMR_LAMBDA = float(os.environ.get("QUIZ_BANK_MMR_LAMBDA", "0.6"))
+BANK_TOPIC_PENALTY = 0.15   # per ogni domanda gia' scelta sullo stesso topic
+
+
+def select_diverse(vectors: np.ndarray, topics: List[str], relevance: np.ndarray, count: int,
+                   threshold: float, lam: float = BANK_MMR_LAMBDA) -> List[int]:
+    """
+    Maximal Marginal Relevance con penalita' per topic: ad ogni passo la domanda
+    piu' rilevante e meno simile a quelle gia' scelte; oltre `threshold` di
+    coseno una candidata e' un quasi-duplicato e non viene piu' considerata.
+    """
+    n = len(relevance)
+    if n == 0 or count <= 0: return []
+    _, topic_ids = np.unique(np.asarray(topics, dtype=object).astype(str), return_inverse=True)
+    topic_counts = np.zeros(topic_ids.max() + 1, dtype=np.float32)
+    max_sim = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+
+    chosen = []
+    while len(chosen) < count and available.any():
+        score = lam * relevance - (1 - lam) * max_sim - BANK_TOPIC_PENALTY * topic_counts[topic_ids]
+        score[~available] = -np.inf
+        i = int(np.argmax(score))
+        chosen.append(i)
+        available[i] = False
+        max_sim = np.maximum(max_sim, vectors @ vectors[i])
+        available &= max_sim < threshold
+        topic_counts[topic_ids[i]] += 1
+    return chosen
+
+
+class QuestionBank:
+    """
+    Banca persistente (SQLite) delle domande validate, indicizzata per file:
+    shard_key = hash del contenuto del PDF sorgente, quindi una domanda resta
+    riusabile in ogni contesto che contiene quel file, anche con un altro nome.
+    Ogni riga ha topic, tipo, lingua ed embedding normalizzato (float32).
+    """
+
+    def __init__(self, path: str = BANK_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS questions (
+                    id INTEGER PRIMARY KEY,
+                    shard_key TEXT NOT NULL,
+                    language TEXT NOT NULL,
+                    text_key TEXT NOT NULL,
+                    source_file TEXT,
+                    topic TEXT,
+                    type TEXT,
+                    n_options INTEGER,
+                    model TEXT,
+                    data TEXT,
+                    embedding BLOB,
+                    created REAL,
+                    served INTEGER DEFAULT 0,
+                    UNIQUE (shard_key, language, text_key)
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_questions_corpus ON questions(shard_key, language, type)")
+            self._conn.commit()
+
+    def add(self, questions: List[dict], shards: Dict[str, str], vectors: Optional[np.ndarray],
+            language: str, model: str) -> int:
+        """Salva le domande (shards: nome file -> shard_key del contesto). Ritorna quante sono nuove."""
+        rows = []
+        now = time.time()
+        for i, q in enumerate(questions):
+            key = shards.get(q.get("source_file"))
+            if key is None: continue
+            embedding = vectors[i].astype(np.float32).tobytes() if vectors is not None else None
+            rows.append((key, language.lower(), make_key(normalize_text(q["question"])), q.get("source_file"),
+                         q.get("topic"), q.get("type"), len(q.get("options") or []), model,
+                         json.dumps(q, ensure_ascii=False), embedding, now))
+        if not rows: return 0
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany("""
+                INSERT OR IGNORE INTO questions
+                (shard_key, language, text_key, source_file, topic, type, n_options, model, data, embedding, created)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+    def _candidates(self, shards: Dict[str, str], language: str, qtype: str, max_options: int) -> list:
+        keys = sorted(set(shards.values()))
+        if not keys: return []
+        query = (f"SELECT id, topic, data, embedding, served FROM questions "
+                 f"WHERE shard_key IN ({','.join('?' * len(keys))}) AND language = ? AND type = ?")
+        params = [*keys, language.lower(), qtype]
+        if qtype == "multiple_choice":
+            query += " AND n_options = ?"
+            params.append(max_options)
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def select(self, shards: Dict[str, str], language: str, qtype: str, count: int, max_options: int,
+               threshold: float, query_vector: Optional[np.ndarray] = None, seed: Optional[int] = None) -> tuple:
+        """
+        (domande, embedding, id) scelte con select_diverse. Rilevanza = somiglianza con
+        `query_vector` (se c'e') oppure casuale, ridotta per le domande gia' servite:
+        quiz successivi sullo stesso corpus pescano domande diverse.
+        Il contatore si aggiorna con mark_served, solo per quelle effettivamente usate.
+        """
+        rows = self._candidates(shards, language, qtype, max_options)
+        if not rows or count <= 0: return [], None, []
+        dim = next((len(r[3]) // 4 for r in rows if r[3]), 0)
+        vectors = np.zeros((len(rows), dim), dtype=np.float32)
+        for i, r in enumerate(rows):
+            if r[3] and len(r[3]) == dim * 4: vectors[i] = np.frombuffer(r[3], dtype=np.float32)
+
+        if query_vector is not None and dim:
+            relevance = vectors @ query_vector
+        else:
+            relevance = np.random.default_rng(seed).random(len(rows), dtype=np.float32)
+        relevance = relevance / (1.0 + np.array([r[4] for r in rows], dtype=np.float32))
+
+        chosen = select_diverse(vectors, [r[1] or "" for r in rows], relevance, count, threshold)
+        return ([json.loads(rows[i][2]) for i in chosen], (vectors[chosen] if dim else None),
+                [rows[i][0] for i in chosen])
+
+    def mark_served(self, ids: List[int]):
+        if not ids: return
+        with self._lock:
+            self._conn.executemany("UPDATE questions SET served = served + 1 WHERE id = ?", [(i,) for i in ids])
+            self._conn.commit()
+
+    def drop_shard(self, shard_key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM questions WHERE shard_key = ?", (shard_key,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM questions")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total, files, served = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT shard_key), COALESCE(SUM(served), 0) FROM questions").fetchone()
+        return {"questions": total, "files": files, "served": served}
+
+
+def create_question_bank() -> Optional[QuestionBank]:
+    try:
+        return QuestionBank(BANK_DB_PATH)
+    except Exception as e:
+        print(f"   ⚠️ Question bank unavailable ({e}): quizzes are generated by the LLM only.")
+        return None
@@ -1,4 +1,8 @@
+import os
 import re
+import json
+import bisect
+import unicodedata
 import platform
 import psutil
 import shutil
@@ -18,6 +22,136 @@ def clean_json_output(text: str) -> str:
     
     return text
 
+# Dati persistenti del backend (job, banca domande): fuori dalla cartella di lavoro e dal repository
+DATA_DIR = os.environ.get("QUIZ_DATA_DIR") or os.path.join(os.path.expanduser("~"), ".quiz_generator_pro")
+
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+def _loads_lenient(fragment: str):
+    # Errore tipico degli LLM: virgola prima di } o ]
+    for candidate in (fragment, _TRAILING_COMMA.sub(r"\1", fragment)):
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    return None
+
+class JsonItemStream:
+    """
+    Parser incrementale e tollerante per l'output JSON degli LLM: feed() riceve il
+    testo a pezzi e ritorna ogni oggetto ben formato riconosciuto da `is_item`
+    appena si chiude la sua graffa. Un item rotto, troncato o un involucro non
+    valido non fanno perdere gli item validi intorno. close() fa un'ultima passata
+    con raw_decode per quelli che la scansione ha perso (es. virgolette sbilanciate).
+    `marker` (regex) riconosce l'inizio di ogni item, anche rotto: serve a numerarli
+    come li ha scritti il modello.
+    """
+
+    def __init__(self, is_item, marker: str = None):
+        self.is_item = is_item
+        self.marker = re.compile(marker) if marker else None
+        self._text = ""
+        self._pos = 0
+        self._stack = []        # posizioni delle '{' ancora aperte
+        self._in_string = False
+        self._escape = False
+        self._found = []        # (inizio, fine, oggetto)
+
+    def feed(self, chunk: str) -> list:
+        self._text += chunk
+        text, new = self._text, []
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape: self._escape = False
+                elif c == "\\": self._escape = True
+                elif c == '"': self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                self._stack.append(i)
+            elif c == "}" and self._stack:
+                start = self._stack.pop()
+                obj = _loads_lenient(text[start:i + 1])
+                if isinstance(obj, dict) and self.is_item(obj):
+                    self._found.append((start, i + 1, obj))
+                    new.append(obj)
+        self._pos = len(text)
+        return new
+
+    def close(self) -> list:
+        text, new = self._text, []
+        decoder = json.JSONDecoder()
+        spans = [(s, e) for s, e, _ in self._found]
+        pos = 0
+        while (start := text.find("{", pos)) != -1:
+            inside = next((e for s, e in spans if s <= start < e), None)
+            if inside is not None:
+                pos = inside
+                continue
+            try:
+                obj, end = decoder.raw_decode(text, start)
+            except ValueError:
+                pos = start + 1
+                continue
+            if isinstance(obj, dict) and self.is_item(obj):
+                self._found.append((start, end, obj))
+                new.append(obj)
+                pos = end
+            else:
+                pos = start + 1   # involucro valido o sotto-oggetto: si cercano gli item al suo interno
+        self._found.sort(key=lambda f: f[0])
+        return new
+
+    def _outer(self) -> list:
+        # Solo gli item al livello piu' esterno: un oggetto simile dentro un item (es. un'opzione) non e' un item
+        found = sorted(self._found, key=lambda f: (f[0], -f[1]))
+        outer = []
+        for f in found:
+            if outer and f[1] <= outer[-1][1]: continue
+            outer.append(f)
+        return outer
+
+    @property
+    def items(self) -> list:
+        """Item trovati, nell'ordine in cui compaiono nel testo."""
+        return [obj for _, _, obj in self._outer()]
+
+    def numbered(self) -> list:
+        """
+        [(posizione, item)]: con `marker` la posizione conta anche gli item persi
+        (un item troncato non sposta quelli dopo), altrimenti e' l'indice in `items`.
+        """
+        found = self._outer()
+        if self.marker is None: return list(enumerate(obj for _, _, obj in found))
+        # Marker fuori dagli item trovati = item persi; ogni item trovato conta una volta
+        ends = [e for _, e, _ in found]
+        starts = [s for s, _, _ in found]
+        lost = []
+        for m in self.marker.finditer(self._text):
+            k = bisect.bisect_right(starts, m.start()) - 1
+            if k < 0 or m.start() >= ends[k]: lost.append(m.start())
+        return [(bisect.bisect_left(lost, start) + k, obj) for k, (start, _, obj) in enumerate(found)]
+
+def normalize_text(text: str) -> str:
+    # Forma canonica per le chiavi di cache: maiuscole, spazi e punteggiatura ai bordi non contano
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" .,;:!?\"'")
+
+def estimate_tokens(text: str) -> int:
+    # Stima grezza (~4 caratteri per token): basta per il budget del contesto
+    return len(text) // 4 + 1
+
+def get_memory_stats() -> dict:
+    # Valori numerici (byte / percentuale): li usano sia le specifiche sia le metriche
+    mem = psutil.virtual_memory()
+    return {
+        "total_bytes": mem.total,
+        "used_percent": mem.percent,
+        "process_rss_bytes": psutil.Process().memory_info().rss,
+    }
+
 def get_hardware_specs():
     specs = {
         "cpu": platform.processor() or platform.machine(),
@@ -27,9 +161,9 @@ def get_hardware_specs():
     }
 
     try:
-        mem = psutil.virtual_memory()
-        specs["ram_total"] = f"{round(mem.total / (1024**3), 1)} GB"
-        specs["ram_used"] = f"{mem.percent}%"
+        mem = get_memory_stats()
+        specs["ram_total"] = f"{round(mem['total_bytes'] / (1024**3), 1)} GB"
+        specs["ram_used"] = f"{mem['used_percent']}%"
     except Exception:
         pass
 
@@ -0,0 +1,271 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from .bm25 import BM25Index, term_counts
+from .ann_index import optimize_index, drop_ann_cache
+from .metrics import timed
+from .contexts import LoadedContext, context_fingerprint
+from .chunk_store import ChunkStore, ChunkDocstore, PositionIds, has_chunk_store, write_chunk_store
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# Impostazioni dello splitter: fanno parte della chiave degli shard,
+# cambiarle invalida automaticamente la cache
+CHUNK_SIZE = 1200
+CHUNK_OVERLAP = 200
+
+SPARSE_FILE = "bm25.json"
+
+# "hybrid" = FAISS + BM25 fusi con Reciprocal Rank Fusion, "dense" = solo FAISS
+RETRIEVAL_MODE = os.environ.get("QUIZ_RETRIEVAL", "hybrid")
+RRF_K = 60
+HYBRID_FETCH_FACTOR = 3   # candidati per lista = k * fattore
+DOC_OVERHEAD_BYTES = 600  # oggetto Document + metadati + id del docstore, per chunk
+
+
+def _dense_ids(db, queries: List[str], k: int) -> list:
+    import faiss
+    with timed("embed_query"):
+        vectors = np.array(db.embeddings.embed_documents(queries), dtype=np.float32)
+    if db._normalize_L2: faiss.normalize_L2(vectors)
+    with timed("faiss_search"):
+        _, indices = db.index.search(vectors, k)
+    return [[int(i) for i in row if i != -1] for row in indices]
+
+
+def _docs(db, ids: List[int]) -> list:
+    return [db.docstore.search(db.index_to_docstore_id[i]) for i in ids]
+
+
+def _context_bytes(db, sparse: Optional[BM25Index], report: Optional[dict]) -> int:
+    """Stima della RAM di un contesto: indice FAISS + testo e metadati dei chunk + postings BM25."""
+    n = db.index.ntotal
+    index_bytes = report["index_mb"] * 1024 ** 2 if report and "index_mb" in report else n * db.index.d * 4
+    if isinstance(db.docstore, ChunkDocstore):
+        text_bytes = db.docstore.nbytes   # testi memory-mapped: non occupano heap
+    else:
+        text_bytes = sum(len(d.page_content) + DOC_OVERHEAD_BYTES for d in _docs(db, range(n)))
+    return int(index_bytes + text_bytes + (sparse.nbytes if sparse is not None else 0))
+
+
+def search_many(db, queries: List[str], k: int, sparse: Optional[BM25Index] = None) -> List[list]:
+    """
+    Retrieval batch: un solo forward pass dell'embedder per tutte le query e una
+    sola FAISS search sulla matrice. Stesso risultato di as_retriever(k).invoke(q)
+    per ciascuna query (MiniLM usa gli stessi encode_kwargs per query e documenti).
+    Con `sparse` le classifiche FAISS e BM25 vengono fuse (Reciprocal Rank Fusion):
+    termini esatti come "AES-GCM" o "K >= M" entrano anche se l'embedding li manca.
+    """
+    if not queries: return []
+    unique = list(dict.fromkeys(queries))
+    hybrid = sparse is not None and sparse.size == db.index.ntotal
+
+    fetch = k * HYBRID_FETCH_FACTOR if hybrid else k
+    by_query = {}
+    for q, dense in zip(unique, _dense_ids(db, unique, fetch)):
+        if not hybrid:
+            by_query[q] = _docs(db, dense)
+            continue
+        scores = {}
+        with timed("bm25_search"):
+            keyword = sparse.search(q, fetch)
+        for ranking in (dense, keyword):
+            for rank, doc_id in enumerate(ranking):
+                scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        best = sorted(scores, key=lambda i: -scores[i])[:k]
+        by_query[q] = _docs(db, best)
+    return [by_query[q] for q in queries]
+
+
+class VectorStoreManager:
+    """
+    Tiene in RAM il modello di embedding (caricato una sola volta per processo)
+    e costruisce i contesti: ogni PDF ha il suo shard FAISS su disco
+    (shard_dir/<hash>), indicizzato per hash del contenuto, e un contesto e'
+    il merge degli shard dei suoi file. I contesti residenti li gestisce il ContextRegistry.
+    """
+
+    def __init__(self, db_dir: str, shard_dir: str, ann_dir: str):
+        self.db_dir = db_dir      # indice legacy, solo lettura
+        self.shard_dir = shard_dir
+        self.ann_dir = ann_dir    # cache degli indici ANN dei contesti
+        self._embeddings = None
+        self._hash_memo = {}
+        # RLock: load_context tiene il lock mentre chiama get_embeddings()
+        self.lock = threading.RLock()
+
+    def get_embeddings(self):
+        if self._embeddings is None:
+            with self.lock:
+                if self._embeddings is None:
+                    print(f"🧠 [SYSTEM] Loading embedding model: {EMBEDDING_MODEL}...")
+                    from langchain_huggingface import HuggingFaceEmbeddings
+                    self._embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+        return self._embeddings
+
+    @property
+    def embeddings_loaded(self) -> bool:
+        return self._embeddings is not None
+
+    # --- CONTESTI ---
+
+    def build_context(self, context_id: str, shards: Dict[str, str]) -> Optional[LoadedContext]:
+        """Merge degli shard ancora presenti su disco (file -> chiave) in un contesto residente."""
+        shards = {f: key for f, key in shards.items() if self.has_shard(key)}
+        if not shards: return None
+        db, sparse = self.merge_shards(list(shards.values()))
+        report = self._optimize(db, context_fingerprint(shards.values()))
+        return LoadedContext(context_id, shards, db, sparse, report, _context_bytes(db, sparse, report))
+
+    def load_legacy(self) -> Optional[LoadedContext]:
+        """Formato precedente agli shard: indice unico salvato con save_local in db_dir."""
+        if not os.path.exists(os.path.join(self.db_dir, "index.faiss")): return None
+        from langchain_community.vectorstores import FAISS
+        try:
+            db = FAISS.load_local(self.db_dir, self.get_embeddings(), allow_dangerous_deserialization=True)
+        except Exception as e:
+            print(f"   ⚠️ Could not restore index from disk: {e}")
+            return None
+        sparse = BM25Index([term_counts(d.page_content) for d in _docs(db, range(db.index.ntotal))])
+        report = self._optimize(db, None)
+        return LoadedContext("legacy", {}, db, sparse, report, _context_bytes(db, sparse, report))
+
+    def _optimize(self, db, fingerprint: Optional[str]) -> dict:
+        # Contesti grandi: indice approssimato (HNSW / IVF / PQ) al posto del flat
+        try:
+            return optimize_index(db, self.ann_dir, fingerprint)
+        except Exception as e:
+            print(f"   ⚠️ ANN index build failed, keeping flat index: {e}")
+            return {"type": "flat", "chunks": db.index.ntotal, "error": str(e)}
+
+    def drop_ann(self, fingerprints: Optional[List[str]] = None):
+        """Indici ANN in cache dei contesti eliminati (tutti se None)."""
+        drop_ann_cache(self.ann_dir, fingerprints)
+
+    # --- SHARD PER FILE ---
+
+    def shard_key(self, path: str) -> str:
+        """Hash di (bytes del PDF, impostazioni splitter, modello di embedding)."""
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key in self._hash_memo:
+            return self._hash_memo[memo_key]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        key = self.finish_key(h)
+        self._hash_memo[memo_key] = key
+        return key
+
+    @staticmethod
+    def finish_key(h) -> str:
+        """Chiave dello shard da un sha256 gia' aggiornato con i bytes del PDF (es. durante l'upload)."""
+        h.update(f"|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{EMBEDDING_MODEL}".encode())
+        return h.hexdigest()
+
+    def remember_key(self, path: str, key: str):
+        """Registra la chiave di un file appena scritto: load_context non lo rilegge per l'hash."""
+        stat = os.stat(path)
+        self._hash_memo[(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)] = key
+
+    def known_key(self, path: str) -> Optional[str]:
+        """Chiave gia' calcolata per il file (nessuna lettura del contenuto)."""
+        try: stat = os.stat(path)
+        except OSError: return None
+        return self._hash_memo.get((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+
+    def has_shard(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.shard_dir, key, "index.faiss"))
+
+    def save_shard(self, key: str, db):
+        """Shard = index.faiss (vettori) + chunk store (testi memory-mapped) + bm25.json, niente pickle."""
+        import faiss
+        final_dir = os.path.join(self.shard_dir, key)
+        tmp_dir = final_dir + ".tmp"
+        if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        faiss.write_index(db.index, os.path.join(tmp_dir, "index.faiss"))
+        docs = _docs(db, range(db.index.ntotal))
+        write_chunk_store(tmp_dir, docs)
+        self._write_terms(tmp_dir, [d.page_content for d in docs])
+        if os.path.exists(final_dir): shutil.rmtree(final_dir)
+        os.replace(tmp_dir, final_dir)
+
+    def load_shard(self, key: str):
+        """(indice FAISS, ChunkStore) dello shard: i testi restano su disco finche' non servono."""
+        import faiss
+        directory = os.path.join(self.shard_dir, key)
+        if not has_chunk_store(directory): self._migrate_shard(directory)
+        return faiss.read_index(os.path.join(directory, "index.faiss")), ChunkStore(directory)
+
+    def _migrate_shard(self, directory: str):
+        # Shard salvato con save_local (index.pkl): si converte una volta nel chunk store
+        from langchain_community.vectorstores import FAISS
+        db = FAISS.load_local(directory, self.get_embeddings(), allow_dangerous_deserialization=True)
+        write_chunk_store(directory, _docs(db, range(db.index.ntotal)))
+        os.remove(os.path.join(directory, "index.pkl"))
+        print(f"   🔁 Shard {os.path.basename(directory)[:12]} converted to chunk store")
+
+    def drop_shard(self, key: str):
+        """
+        Cancella lo shard: prima lo si rinomina (operazione atomica), cosi' un errore a meta'
+        non lascia una directory con i chunk ma senza index.faiss che blocca il prossimo save_shard.
+        Solleva OSError se lo shard e' ancora in uso (file mappati di un contesto non chiuso).
+        """
+        path = os.path.join(self.shard_dir, key)
+        if not os.path.exists(path): return
+        trash = path + ".deleting"
+        if os.path.exists(trash): shutil.rmtree(trash)
+        os.replace(path, trash)
+        shutil.rmtree(trash)
+
+    def _write_terms(self, directory: str, texts: List[str]) -> list:
+        # Conteggi dei termini per chunk, nell'ordine delle posizioni FAISS
+        terms = [term_counts(t) for t in texts]
+        with open(os.path.join(directory, SPARSE_FILE), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        return terms
+
+    def _shard_terms(self, key: str, store: ChunkStore) -> list:
+        path = os.path.join(self.shard_dir, key, SPARSE_FILE)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Shard creato prima dell'indice BM25: si calcola una volta e si salva
+            return self._write_terms(os.path.join(self.shard_dir, key), [store.text(i) for i in range(len(store))])
+
+    def merge_shards(self, keys: List[str]):
+        """
+        Merge degli shard: (indice FAISS, indice BM25) del contesto. Si uniscono
+        solo i vettori; i chunk restano nei rispettivi store, indicizzati per posizione.
+        Gli shard si uniscono in ordine di chiave: le posizioni dipendono solo
+        dall'insieme dei file (come il fingerprint che indicizza la cache ANN).
+        """
+        import faiss
+        from langchain_community.vectorstores import FAISS
+        indexes, stores, doc_terms = [], [], []
+        # Due file identici condividono lo stesso shard: lo si carica una volta sola
+        for key in sorted(set(keys)):
+            index, store = self.load_shard(key)
+            doc_terms.extend(self._shard_terms(key, store))
+            indexes.append(index)
+            stores.append(store)
+        if not indexes: return None, None
+
+        index = indexes[0]
+        if len(indexes) > 1:
+            index = faiss.IndexFlatL2(indexes[0].d)
+            for shard_index in indexes: index.add(shard_index.reconstruct_n(0, shard_index.ntotal))
+        merged = FAISS(self.get_embeddings(), index, ChunkDocstore(stores), PositionIds(index.ntotal))
+        sparse = BM25Index(doc_terms)
+        print(f"   🔤 BM25 index: {sparse.stats()}")
+        return merged, sparse